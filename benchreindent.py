@@ -0,0 +1,326 @@
+#! /usr/bin/env python
+
+"""benchreindent [-g FILE [-u]] [-e MODULE:CLASS] [-o FILE] [-s MB] [-n] [path ...]
+
+-g (--golden) FILE   Compare output hashes with the golden hashes in FILE.
+-u (--update)        Write the golden hashes to the --golden FILE instead.
+-e (--engine) M:C    Also run class C of module M (same interface as
+                     reindent.Reindenter) and compare its output with the
+                     reference byte for byte.
+-o (--output) FILE   Write the full results as JSON to FILE.
+-s (--size) MB       Size of the generated huge module (default 50).
+-n (--no-stdlib)     Don't add the installed standard library to the corpus.
+-h (--help)          Print this usage information and exit.
+
+Benchmark and regression-test reindent.Reindenter.  The corpus is made of
+the .py files under the given paths (default: the standard library of the
+running interpreter, without its site-packages) plus generated pathological files: deep nesting, huge
+comment blocks, mixed tab/space indentation, very long lines and a huge
+module.  For each file, Reindenter.run() and write() are timed, and the
+result of run() and a hash of the written output are recorded.
+
+The summary gives lines/sec for the whole corpus, the worst files, and the
+peak memory of the process.  With --golden, any change of output against a
+previous run is reported, as are files of the golden run missing from the
+corpus; with --engine, any difference between the alternative engine and the
+reference.  The exit status is 1 if there is a mismatch.
+
+Files are named by their path relative to the parent of the given path, or
+to <stdlib>, so golden files can be compared across machines.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import resource
+from StringIO import StringIO
+
+from reindent import Reindenter
+
+
+def usage(msg=None):
+    if msg is not None:
+        print >> sys.stderr, msg
+    print >> sys.stderr, __doc__
+
+
+def peakmemory():
+    """Return the peak resident memory of the process, in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes there
+        peak //= 1024
+    return peak
+
+
+# --- corpus
+
+# third-party packages installed in the standard library directory, which
+# differ between machines
+SITEDIRS = ('site-packages', 'dist-packages')
+
+
+def pyfiles(path, skip=()):
+    """Yield the .py files under 'path', leaving out directories named in
+    'skip'."""
+    if os.path.isfile(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in skip)
+        for name in sorted(files):
+            if name.endswith('.py'):
+                yield os.path.join(root, name)
+
+
+def corpusname(path, name, label=None):
+    """Return the name of file 'name' found under 'path' in the results
+    and golden files: its path relative to the parent of 'path', or to
+    'label' instead of 'path', so that it is the same on every machine."""
+    path = os.path.normpath(path)
+    if label is None:
+        label = os.path.basename(path)
+    if name == path:
+        return label
+    return '/'.join([label] + os.path.relpath(name, path).split(os.sep))
+
+
+def deepnesting(depth=90):
+    # stay below the parser's limit of 100 nested blocks
+    lines = []
+    for i in xrange(depth):
+        lines.append('  ' * i + 'if x%d:\n' % i)
+    lines.append('  ' * depth + 'pass\n')
+    return ''.join(lines) * 200
+
+
+def commentblocks(count=200, size=500):
+    block = []
+    for i in xrange(size):
+        block.append('    ' * (i % 3) + '# comment line %d\n' % i)
+    parts = []
+    for i in xrange(count):
+        parts.append('def f%d():\n' % i)
+        parts.extend(block)
+        parts.append('        return %d\n\n' % i)
+    return ''.join(parts)
+
+
+def mixedtabs(count=5000):
+    parts = []
+    for i in xrange(count):
+        parts.append('class C%d:\n'
+                     '\tdef m(self):\n'
+                     '\t    if self:\n'
+                     '    \t\treturn %d   \n'
+                     '\t\n' % (i, i))
+    return ''.join(parts)
+
+
+def longlines(count=20, width=100000):
+    parts = []
+    for i in xrange(count):
+        parts.append('x%d = [%s]\n' % (i, ', '.join(['1'] * (width // 3))))
+    return ''.join(parts)
+
+
+def hugemodule(megabytes):
+    chunk = ('def function_%d(a, b):\n'
+             '    """Docstring."""\n'
+             '    if a:\n'
+             '        return b  \n'
+             '    # comment\n'
+             '    for i in range(a):\n'
+             '\tb += i\n'
+             '    return b\n\n')
+    parts = []
+    size = 0
+    i = 0
+    while size < megabytes * 1024 * 1024:
+        part = chunk % i
+        parts.append(part)
+        size += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+def generated(size):
+    yield '<deep-nesting>', deepnesting()
+    yield '<comment-blocks>', commentblocks()
+    yield '<mixed-tabs>', mixedtabs()
+    yield '<long-lines>', longlines()
+    yield '<huge-module>', hugemodule(size)
+
+
+def corpus(paths, stdlib, size):
+    roots = [(path, None, ()) for path in paths]
+    if stdlib:
+        roots.append((os.path.dirname(os.__file__), '<stdlib>', SITEDIRS))
+    for path, label, skip in roots:
+        for name in pyfiles(path, skip):
+            try:
+                fp = open(name)
+            except IOError, msg:
+                print >> sys.stderr, '%s: I/O Error: %s' % (name, msg)
+                continue
+            try:
+                data = fp.read()
+            finally:
+                fp.close()
+            yield corpusname(path, name, label), data
+    for name, data in generated(size):
+        yield name, data
+
+
+# --- benchmark
+
+def runengine(engine, data):
+    """Return (changed, output, seconds) for one run of 'engine'."""
+    start = time.time()
+    r = engine(StringIO(data))
+    changed = bool(r.run())
+    out = StringIO()
+    r.write(out)
+    return changed, out.getvalue(), time.time() - start
+
+
+def loadengine(spec):
+    module, name = spec.split(':', 1)
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+def bench(files, engine=None, golden=None):
+    results = {}
+    totals = {'files': 0, 'lines': 0, 'bytes': 0, 'seconds': 0.0,
+              'engine_seconds': 0.0}
+    mismatches = []
+    for name, data in files:
+        lines = data.count('\n')
+        changed, out, secs = runengine(Reindenter, data)
+        digest = hashlib.sha1(out).hexdigest()
+        res = results[name] = {
+            'lines': lines,
+            'bytes': len(data),
+            'seconds': secs,
+            'changed': changed,
+            'sha1': digest,
+        }
+        totals['files'] += 1
+        totals['lines'] += lines
+        totals['bytes'] += len(data)
+        totals['seconds'] += secs
+        if golden is not None and name in golden:
+            if golden[name] != [changed, digest]:
+                mismatches.append((name, 'golden'))
+        if engine is not None:
+            echanged, eout, esecs = runengine(engine, data)
+            res['engine_seconds'] = esecs
+            totals['engine_seconds'] += esecs
+            if echanged != changed or eout != out:
+                mismatches.append((name, 'engine'))
+    if golden is not None:
+        for name in sorted(golden):
+            if name not in results:
+                mismatches.append((name, 'missing'))
+    return results, totals, mismatches
+
+
+def rate(lines, seconds):
+    return seconds and lines / seconds or 0.0
+
+
+def main():
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "g:ue:o:s:nh",
+                                   ["golden=", "update", "engine=", "output=",
+                                    "size=", "no-stdlib", "help"])
+    except getopt.error, msg:
+        usage(msg)
+        return 2
+    goldenfile = enginespec = output = None
+    update = False
+    stdlib = True
+    size = 50
+    for o, a in opts:
+        if o in ('-g', '--golden'):
+            goldenfile = a
+        elif o in ('-u', '--update'):
+            update = True
+        elif o in ('-e', '--engine'):
+            enginespec = a
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-s', '--size'):
+            size = float(a)
+        elif o in ('-n', '--no-stdlib'):
+            stdlib = False
+        elif o in ('-h', '--help'):
+            usage()
+            return 0
+    if update and not goldenfile:
+        usage('--update needs --golden')
+        return 2
+
+    golden = None
+    if goldenfile and not update:
+        fp = open(goldenfile)
+        try:
+            golden = json.load(fp)
+        finally:
+            fp.close()
+    engine = enginespec and loadengine(enginespec) or None
+
+    results, totals, mismatches = bench(corpus(args, stdlib, size),
+                                        engine, golden)
+
+    print '%d files, %d lines, %.1f MB' % (totals['files'], totals['lines'],
+                                           totals['bytes'] / 1048576.0)
+    print 'reference: %.1fs, %.0f lines/sec' % (
+        totals['seconds'], rate(totals['lines'], totals['seconds']))
+    if engine is not None:
+        print '%s: %.1fs, %.0f lines/sec' % (
+            enginespec, totals['engine_seconds'],
+            rate(totals['lines'], totals['engine_seconds']))
+    print 'peak memory: %d KB' % peakmemory()
+    print 'slowest files:'
+    slowest = sorted(results.iteritems(), key=lambda x: -x[1]['seconds'])
+    for name, res in slowest[:10]:
+        print '  %8.3fs %10.0f lines/sec  %s' % (
+            res['seconds'], rate(res['lines'], res['seconds']), name)
+
+    if update:
+        fp = open(goldenfile, 'w')
+        try:
+            json.dump(dict((name, [res['changed'], res['sha1']])
+                           for name, res in results.iteritems()),
+                      fp, indent=1, sort_keys=True)
+        finally:
+            fp.close()
+        print 'wrote golden hashes for %d files to %s' % (len(results),
+                                                          goldenfile)
+    if output:
+        fp = open(output, 'w')
+        try:
+            json.dump({'totals': totals, 'files': results,
+                       'mismatches': mismatches, 'engine': enginespec,
+                       'peak_kb': peakmemory()},
+                      fp, indent=1, sort_keys=True)
+        finally:
+            fp.close()
+
+    if golden is not None:
+        new = [name for name in results if name not in golden]
+        if new:
+            print 'warning: %d files have no golden hash, e.g. %s' % (
+                len(new), sorted(new)[0])
+    for name, kind in mismatches:
+        print 'MISMATCH (%s): %s' % (kind, name)
+    return mismatches and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,11 +12,34 @@ pretxnchangegroup.checkbranch = python:/home/hg/repos/hooks/checkbranch.py:hook
 allow-branches = default, 3.2, 3.1, 2.7, 2.6, 2.5
 """
 
+# Mercurial hooks are not run with the hook's directory in sys.path
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
 from mercurial.node import bin
 from mercurial import util
 
+import hookmetrics
+
+
+def check_changeset(ui, ctx, branches):
+    """Return True if changeset 'ctx' is on a branch not in 'branches'."""
+    branch = ctx.branch()
+    if branch not in branches:
+        ui.warn(' - changeset %s on disallowed branch %r!\n'
+              % (ctx, branch))
+        return True
+    return False
+
 
 def hook(ui, repo, node, **kwargs):
+    try:
+        return _hook(ui, repo, node, **kwargs)
+    finally:
+        hookmetrics.flush(ui)
+
+
+def _hook(ui, repo, node, **kwargs):
     branches = ui.configlist('checkbranch', 'allow-branches')
     if not branches:
         print 'checkbranch: No branches are configured'
@@ -26,13 +49,10 @@ def hook(ui, repo, node, **kwargs):
     start = repo.changelog.rev(n)
     end = len(repo.changelog)
     failed = False
+    hookmetrics.incr('changesets', end - start, hook='checkbranch')
     for rev in xrange(start, end):
         n = repo.changelog.node(rev)
-        ctx = repo[n]
-        branch = ctx.branch()
-        if branch not in branches:
-            ui.warn(' - changeset %s on disallowed branch %r!\n'
-                  % (ctx, branch))
+        if check_changeset(ui, repo[n], branches):
             failed = True
     if failed:
         ui.warn('* Please strip the offending changeset(s)\n'
@@ -8,53 +8,180 @@ and reindent.py are in the same directory.
 
 [hooks]
 pretxncommit.whitespace = python:/home/hg/repos/hooks/checkwhitespace.py:check_whitespace_single
+
+If a hook daemon is configured (see hookdaemon.py), file contents are checked
+there, so that its cache of already checked contents is reused across pushes.
+
+The size of a file revision is looked up in its filelog before the contents
+are read.  Python files larger than `max-size` bytes only get a cheap line
+scan for tabs in the indentation and trailing whitespace instead of a full
+reindent.py run, and files larger than `skip-size` bytes, like binary files,
+are not checked at all.  A limit of 0 means no limit.
+
+[checkwhitespace]
+max-size = 1048576
+skip-size = 16777216
+
+Once the hook's budget in the [hooks-budget] section is exceeded, only a
+sample of the remaining files is checked; see hookbudget.py.
 """
 
 # Mercurial hooks are not run with the hook's directory in sys.path
 import sys, os
 sys.path.append(os.path.dirname(__file__))
 
-from StringIO import StringIO
 from reindent import Reindenter
 from mercurial import revset
 from mercurial import node
 from mercurial import cmdutil
+from mercurial import util
 
-def check_file(ui, repo, path, rev):
-    """Check a particular (file, revision) pair for whitespace issues.
+import hookbudget
+import hookmetrics
+import hookdaemon
+import hooksnapshot
 
-    Return True if whitespace problems exist, else False.
+# the files check_content knows how to check
+CHECKED = ('.py', '.rst')
+
+# default size limits in bytes, see check_file
+MAXSIZE = 1024 * 1024
+SKIPSIZE = 16 * 1024 * 1024
+# over budget, one in SAMPLE files is still checked
+SAMPLE = 10
+
+class Lines(object):
+    """Read-only file object over a string, for Reindenter, which only
+    calls readlines().  Saves copying the contents into a StringIO."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def readlines(self):
+        return self.data.splitlines(True)
+
+def scan_python(data):
+    """Cheap line scan of Python source 'data', for files too large for
+    reindent.py.  Return a description of the first problem found, or None.
 
     """
-    ui.debug("checking file %s at revision %s for whitespace issues\n" %
-             (path, node.short(repo[rev].node())))
+    for line in data.splitlines():
+        code = line.lstrip(' \t')
+        if '\t' in line[:len(line) - len(code)]:
+            return "has tabs in its indentation"
+        elif line.rstrip('\r') != line.rstrip('\r \t'):
+            return "has trailing whitespace"
+    return None
 
+def check_content(path, data, scan=False):
+    """Check the contents 'data' of file 'path' for whitespace issues.
+
+    With 'scan', Python files only get the cheap line scan of scan_python.
+    Return a description of the first problem found, or None.
+
+    """
     # Check Python files using reindent.py
     if path.endswith('.py'):
-        content = StringIO(repo[rev][path].data())
-        reindenter = Reindenter(content)
+        if scan:
+            return scan_python(data)
+        reindenter = Reindenter(Lines(data))
         if reindenter.run():
-            ui.warn(" - file %s is not whitespace-normalized in %s\n"
-                    % (path, str(repo[rev])))
-            return True
+            return "is not whitespace-normalized"
 
     # Check ReST files for tabs and trailing whitespace
     elif path.endswith('.rst'):
-        lines = StringIO(repo[rev][path].data()).readlines()
-        for line in lines:
+        for line in data.splitlines(True):
             if '\t' in line:
-                ui.warn(" - file %s contains tabs in %s\n"
-                        % (path, str(repo[rev])))
-                return True
+                return "contains tabs"
 
             elif line.rstrip('\r\n') != line.rstrip('\r\n '):
-                ui.warn(" - file %s has trailing whitespace in %s\n"
-                        % (path, str(repo[rev])))
-                return True
+                return "has trailing whitespace"
+
+    return None
+
+def check_file(ui, repo, path, rev, filenode=None):
+    """Check a particular (file, revision) pair for whitespace issues.
+
+    If the filenode of 'path' in 'rev' is already known, passing it saves
+    a manifest lookup.
+
+    Return True if whitespace problems exist, else False.
+
+    """
+    ui.debug("checking file %s at revision %s for whitespace issues\n" %
+             (path, node.short(repo[rev].node())))
+    if not path.endswith(CHECKED):
+        return False
+    hookmetrics.incr('files_checked', hook='checkwhitespace')
+
+    fl = repo.file(path)
+    if filenode is None:
+        filenode = repo[rev].filenode(path)
+    # from the filelog index, without reading the contents
+    size = fl.size(fl.rev(filenode))
+    maxsize = int(ui.config('checkwhitespace', 'max-size', MAXSIZE))
+    skipsize = int(ui.config('checkwhitespace', 'skip-size', SKIPSIZE))
+    if skipsize and size > skipsize:
+        hookmetrics.incr('files_skipped', hook='checkwhitespace',
+                         reason='size')
+        ui.status(" - file %s not checked, it is too large (%d bytes)\n"
+                  % (path, size))
+        return False
+    scan = bool(maxsize) and size > maxsize
 
+    data = fl.read(filenode)
+    if util.binary(data):
+        hookmetrics.incr('files_skipped', hook='checkwhitespace',
+                         reason='binary')
+        ui.debug("skipping binary file %s\n" % path)
+        return False
+    if scan:
+        hookmetrics.incr('files_scanned', hook='checkwhitespace')
+        ui.debug("file %s is %d bytes, only scanning its lines\n"
+                 % (path, size))
+        resp = None
+    else:
+        resp = hookdaemon.trycall(ui, 'whitespace', path=path,
+                                  data=data.decode('latin-1'))
+    if resp is None:
+        problem = check_content(path, data, scan)
+    else:
+        problem = resp['result']
+    if problem:
+        ui.warn(" - file %s %s in %s\n" % (path, problem, str(repo[rev])))
+        return True
     return False
 
-def compare_revisions(repo, ui, rev1, rev2):
+def check_files(ui, repo, files, budget=None):
+    """Check the (path, rev, filenode) triples in 'files' for whitespace
+    issues, see check_file.
+
+    Once 'budget', a hookbudget.Budget, is exceeded, only one in every
+    [hooks-budget] checkwhitespace.sample of the remaining files is checked,
+    always the same ones for the same files.
+
+    Returns a count of bad files.
+
+    """
+    bad_files = 0
+    sampled = skipped = 0
+    if budget is not None:
+        sample = int(budget.limit('sample', SAMPLE)) or 1
+    for path, rev, filenode in files:
+        if budget is not None and not budget.check('files'):
+            # check the first of every 'sample' files over budget
+            sampled += 1
+            if (sampled - 1) % sample:
+                skipped += 1
+                continue
+        if check_file(ui, repo, path, rev, filenode):
+            bad_files += 1
+    if skipped:
+        budget.warn('%d of %d files were not checked'
+                    % (skipped, len(files)))
+    return bad_files
+
+def compare_revisions(repo, ui, rev1, rev2, budget=None):
     """Given a known good revision 'rev1' and a revision 'rev2',
     check all files that have changed between 'rev1' and 'rev2'
     for whitespace issues.
@@ -62,13 +189,73 @@ def compare_revisions(repo, ui, rev1, rev2):
     Returns a count of bad files.
 
     """
-    bad_files = 0
     status = repo.status(rev1, rev2)
     modified, added = status[0], status[1]
-    for path in modified + added:
-        if check_file(ui, repo, path, rev2):
-            bad_files += 1
-    return bad_files
+    return check_files(ui, repo, [(path, rev2, None)
+                                  for path in modified + added
+                                  if path.endswith(CHECKED)], budget)
+
+def filelinks(repo, f, start):
+    """Return {linkrev: filenode} for the revisions of file 'f' added from
+    changeset 'start' on.  Only the filelog index is read: the revisions of
+    a changegroup are appended at the end of the filelogs."""
+    fl = repo.file(f)
+    links = {}
+    i = len(fl) - 1
+    while i >= 0 and fl.linkrev(i) >= start:
+        links[fl.linkrev(i)] = fl.node(i)
+        i -= 1
+    return links
+
+def resolve_filenodes(repo, start, heads, files):
+    """Find the file revisions of 'files' in each head of the changegroup
+    starting at revision 'start'.
+
+    Returns a {(path, filenode): head} dict with one entry per distinct
+    file revision, attributed to the first head containing it.
+
+    Instead of loading the full manifest of every head, this follows the
+    first parents of each head through the changegroup down to the
+    changeset that last touched a file according to the changelog, and
+    takes the file revision linked to that changeset from the filelog
+    index.  A file not touched on the way down to the base is the same as
+    in the base, which was already accepted, and is left out.
+
+    Only where the filelog does not tell (the file was removed, or went
+    back to a file revision linked to an earlier changeset) is the file
+    looked up in the manifest.  A merge does not list the files it took
+    unchanged from its second parent, so the files still wanted when the
+    walk reaches a merge are all looked up in its manifest, read once.
+    """
+    snap = hooksnapshot.get(repo)
+    links = {}
+    found = {}
+    for head in sorted(heads):
+        wanted = set(files)
+        rev = head
+        while wanted and rev >= start:
+            r = snap[rev]
+            if len(r.parents) > 1:
+                touched = set(wanted)
+                manifest = repo.manifest.read(r.manifest)
+            else:
+                touched = wanted.intersection(r.files)
+                manifest = None
+            for f in touched:
+                if manifest is not None:
+                    filenode = manifest.get(f)
+                else:
+                    if f not in links:
+                        links[f] = filelinks(repo, f, start)
+                    filenode = links[f].get(rev)
+                    if filenode is None:
+                        filenode = repo.manifest.find(r.manifest, f)[0]
+                # no filenode: removed in this head
+                if filenode is not None:
+                    found.setdefault((f, filenode), head)
+            wanted -= touched
+            rev = r.parents[0] if r.parents else node.nullrev
+    return found
 
 def check_whitespace(ui, repo, node, **kwargs):
     """Check whitespace for an incoming changegroup.
@@ -76,26 +263,32 @@ def check_whitespace(ui, repo, node, **kwargs):
     Suitable for use as a pretxnchangegroup hook.
 
     """
-    bad_files = 0
+    try:
+        return _check_whitespace(ui, repo, node, **kwargs)
+    finally:
+        hookmetrics.flush(ui)
 
+def _check_whitespace(ui, repo, node, **kwargs):
     # revision number of first incoming changeset of the changegroup
     start = repo[node].rev()
     files = set()
     heads = set([start])
+    hookmetrics.incr('changesets', len(repo) - start, hook='checkwhitespace')
+    snap = hooksnapshot.get(repo)
     # Find all heads in changegroup
     for rev in xrange(start, len(repo)):
-        for p in repo.changelog.parentrevs(rev):
+        r = snap[rev]
+        for p in r.parents:
             heads.discard(p)
         heads.add(rev)
-        files.update(repo[rev].files())
-    # Process each head and check modified files in it
-    for head in heads:
-        ctx = repo[head]
-        for f in files:
-            if f not in ctx:
-                continue
-            if check_file(ui, repo, f, head):
-                bad_files += 1
+        files.update(f for f in r.files if f.endswith(CHECKED))
+    # Check each distinct version of the modified files in the heads
+    filenodes = resolve_filenodes(repo, start, heads, files)
+    bad_files = check_files(ui, repo,
+                            [(f, head, filenode) for (f, filenode), head
+                             in sorted(filenodes.iteritems(),
+                                       key=lambda x: (x[1], x[0][0]))],
+                            hookbudget.Budget(ui, 'checkwhitespace'))
 
     if bad_files:
         msg = ("* Run Tools/scripts/reindent.py on .py files or "
@@ -112,12 +305,20 @@ def check_whitespace_single(ui, repo, **kwargs):
     Suitable for use as a pretxncommit hook.
 
     """
+    try:
+        return _check_whitespace_single(ui, repo, **kwargs)
+    finally:
+        hookmetrics.flush(ui)
+
+def _check_whitespace_single(ui, repo, **kwargs):
+    hookmetrics.incr('changesets', hook='checkwhitespace')
     head = repo[kwargs['node']].rev()
     # Enough to compare with just one parent:  both parents should
     # be whitespace-clean already.
     source = repo[kwargs['parent1']].rev()
 
-    if compare_revisions(repo, ui, source, head):
+    budget = hookbudget.Budget(ui, 'checkwhitespace')
+    if compare_revisions(repo, ui, source, head, budget):
         msg = ("* Run Tools/scripts/reindent.py on .py files or "
                "Tools/scripts/reindent-rst.py on .rst files listed above\n"
                "* and rerun your tests to fix this before checking in.\n")
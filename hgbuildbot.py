@@ -17,13 +17,40 @@
 #   [hgbuildbot]
 #   master = host1:port1,host2:port2,...
 #   prefix = python/   # optional!
+#
+# by default one buildbot change is sent per changeset.  With
+#
+#   coalesce = True
+#   max-files = 500    # optional, cap on the files of a coalesced change
+#
+# all new changesets on a branch are merged into a single change for the tip
+# of that branch, so that a large push triggers one build per builder.
+#
+# changes can be filtered by branch and by path (glob patterns, matched
+# before the prefix is added; a changeset touching only skipped paths is not
+# sent at all):
+#
+#   branches = default, 3.4        # optional, only send these branches
+#   skip-branches = 2.5, 2.6       # the default
+#   skip-paths = Doc/*, Misc/NEWS  # optional
+#
+# the timeout and circuit breaker for the masters are configured in the
+# [hooksinks] section, see hooksinks.py.  once the hook's budget in the
+# [hooks-budget] section is exceeded, only the last changeset of each branch
+# is sent for the changesets left over, and all changes are coalesced; see
+# hookbudget.py.
 
 import os
 import sys
+import time
+import fnmatch
 from cStringIO import StringIO
 
+# Mercurial hooks are not run with the hook's directory in sys.path
+sys.path.append(os.path.dirname(__file__))
+
 from mercurial.i18n import gettext as _
-from mercurial.node import bin, hex, nullid
+from mercurial.node import bin, hex
 from mercurial.context import workingctx
 from mercurial.encoding import localstr, fromlocal
 
@@ -38,12 +65,18 @@ except ImportError:
 
 from twisted.internet import defer, reactor
 
+import hookbudget
+import hookmetrics
+import hooksinks
+import hooksnapshot
+
 
-def sendchanges(ui, master, changes):
+def sendchanges(ui, master, changes, breaker=None):
     # send change information to one master
     from buildbot.clients import sendchange
 
     s = sendchange.Sender(master)
+    start = time.time()
     d = defer.Deferred()
     reactor.callLater(0, d.callback, None)
 
@@ -59,17 +92,172 @@ def sendchanges(ui, master, changes):
         d.addCallback(send, change)
 
     def printSuccess(res):
+        hookmetrics.observe('buildbot_send_seconds', time.time() - start,
+                            master=master)
+        if breaker is not None:
+            breaker.succeeded()
         print "change(s) sent successfully"
 
     def printFailure(why):
+        hookmetrics.observe('buildbot_send_seconds', time.time() - start,
+                            master=master)
+        hookmetrics.incr('sink_failures', sink='buildbot', master=master)
+        if breaker is not None:
+            breaker.failed()
         print "change(s) NOT sent, something went wrong:"
         print why
 
     d.addCallbacks(printSuccess, printFailure)
-    d.addBoth(lambda _: reactor.stop())
+    return d
+
+
+# No buildbot category for these branches
+SKIP_BRANCHES = ['2.5', '2.6']
+MAX_FILES = 500
+
+
+class ChangeFilter(object):
+    """Decides which branches and files are sent to buildbot."""
+
+    def __init__(self, branches=(), skipbranches=SKIP_BRANCHES, skippaths=()):
+        self.branches = set(branches)
+        self.skipbranches = set(skipbranches)
+        self.skippaths = list(skippaths)
+
+    def wantbranch(self, branch):
+        if self.branches and branch not in self.branches:
+            return False
+        return branch not in self.skipbranches
+
+    def wantfiles(self, files):
+        if not self.skippaths:
+            return files
+        return [f for f in files
+                if not [p for p in self.skippaths if fnmatch.fnmatch(f, p)]]
+
+
+def getfilter(ui):
+    return ChangeFilter(
+        ui.configlist('hgbuildbot', 'branches'),
+        ui.configlist('hgbuildbot', 'skip-branches', SKIP_BRANCHES),
+        ui.configlist('hgbuildbot', 'skip-paths'))
+
+
+def getchange(repo, rev, prefix='', url='', filter=None):
+    """Return the buildbot change for revision 'rev', or None if skipped."""
+    if filter is None:
+        filter = ChangeFilter()
+    # read changeset
+    snap = hooksnapshot.get(repo)
+    r = snap[rev]
+    node, user, files, desc, branch = (r.node, r.user, r.files,
+                                       r.description, r.branch)
+    if not filter.wantbranch(branch):
+        return None
+    if len(r.parents) > 1:
+        # Explicitly compare current with its first parent (otherwise
+        # some files might be "forgotten" if they are copied as-is from the
+        # second parent).
+        files = snap.changedfiles(rev)
+        if not files:
+            # dummy merge, but at least one file is required by buildbot
+            files.append("Misc/merge")
+    if files:
+        files = filter.wantfiles(files)
+        if not files:
+            # only skipped paths were touched
+            return None
+    # add artificial prefix if configured
+    files = [prefix + f for f in files]
+    return {
+        'who': user,
+        'revision': hex(node),
+        'comments': desc,
+        'revlink': (url % {'rev': hex(node)}) if url else '',
+        'files': files,
+        'branch': branch,
+    }
+
+
+def branchtips(repo, start, end, prefix='', url='', filter=None):
+    """Return the buildbot changes for the last wanted revision of each
+    branch among revisions start..end-1."""
+    snap = hooksnapshot.get(repo)
+    changes = []
+    done = set()
+    for rev in xrange(end - 1, start - 1, -1):
+        branch = snap[rev].branch
+        if branch in done:
+            continue
+        change = getchange(repo, rev, prefix, url, filter)
+        if change is not None:
+            done.add(branch)
+            changes.append(change)
+    changes.reverse()
+    return changes
+
+
+def coalesce(changes, maxfiles=MAX_FILES):
+    """Merge the changes on each branch into one change for its tip.
+
+    The merged change carries the revision and revlink of the last change
+    on the branch, the union of all files (at most 'maxfiles' of them) and
+    the combined authors and comments.  These are combined in UTF-8, since
+    joining the local strings would lose their UTF-8 form.
+    """
+    branches = []
+    bybranch = {}
+    for change in changes:
+        branch = change['branch']
+        if branch not in bybranch:
+            branches.append(branch)
+            bybranch[branch] = []
+        bybranch[branch].append(change)
+
+    coalesced = []
+    for branch in branches:
+        group = bybranch[branch]
+        if len(group) == 1:
+            coalesced.append(group[0])
+            continue
+        tip = group[-1]
+        authors = []
+        files = []
+        seen = set()
+        comments = []
+        for change in group:
+            who = fromlocal(change['who'])
+            if who not in authors:
+                authors.append(who)
+            for f in change['files']:
+                if f not in seen:
+                    seen.add(f)
+                    files.append(f)
+            comments.append('%s (%s):\n%s' % (change['revision'][:12], who,
+                                               fromlocal(change['comments'])))
+        if len(files) > maxfiles:
+            files = files[:maxfiles]
+        coalesced.append({
+            'who': ', '.join(authors),
+            'revision': tip['revision'],
+            'comments': ('%d changesets on %s\n\n' % (len(group),
+                                                     fromlocal(branch)) +
+                         '\n\n'.join(comments)),
+            'revlink': tip['revlink'],
+            'files': files,
+            'branch': branch,
+        })
+    return coalesced
 
 
 def hook(ui, repo, hooktype, node=None, source=None, **kwargs):
+    try:
+        return _hook(ui, repo, hooktype, node, source, **kwargs)
+    finally:
+        hookmetrics.flush(ui)
+
+
+def _hook(ui, repo, hooktype, node=None, source=None, **kwargs):
     # read config parameters
     masters = ui.configlist('hgbuildbot', 'master')
     if not masters:
@@ -78,6 +266,7 @@ def hook(ui, repo, hooktype, node=None, source=None, **kwargs):
         return
     prefix = ui.config('hgbuildbot', 'prefix', '')
     url = ui.config('hgbuildbot', 'rev_url', '')
+    filter = getfilter(ui)
 
     if hooktype != 'changegroup':
         ui.status('hgbuildbot: hook %s not supported\n' % hooktype)
@@ -87,45 +276,53 @@ def hook(ui, repo, hooktype, node=None, source=None, **kwargs):
     changes = []
     start = repo[node].rev()
     end = len(repo)
+    hookmetrics.incr('changesets', end - start, hook='hgbuildbot')
+    budget = hookbudget.Budget(ui, 'hgbuildbot')
     for rev in xrange(start, end):
-        # read changeset
-        node = repo.changelog.node(rev)
-        manifest, user, (time, timezone), files, desc, extra = repo.changelog.read(node)
-        parents = [p for p in repo.changelog.parents(node) if p != nullid]
-        branch = extra['branch']
-        if branch in ['2.5', '2.6']:
-            # No buildbot category for these branches
-            continue
-        if len(parents) > 1:
-            # Explicitly compare current with its first parent (otherwise
-            # some files might be "forgotten" if they are copied as-is from the
-            # second parent).
-            p1 = repo[hex(parents[0])]
-            modified, added, removed, deleted = repo.status(rev, p1)[:4]
-            files = set()
-            for l in (modified, added, removed, deleted):
-                files.update(l)
-            files = sorted(files)
-            if not files:
-                # dummy merge, but at least one file is required by buildbot
-                files.append("Misc/merge")
-        # add artificial prefix if configured
-        files = [prefix + f for f in files]
-        changes.append({
-            'who': user,
-            'revision': hex(node),
-            'comments': desc,
-            'revlink': (url % {'rev': hex(node)}) if url else '',
-            'files': files,
-            'branch': branch,
-        })
+        if not budget.check('changesets'):
+            budget.warn('only sending the branch heads of the changesets '
+                        'from %d' % rev)
+            changes.extend(branchtips(repo, rev, end, prefix, url, filter))
+            break
+        change = getchange(repo, rev, prefix, url, filter)
+        if change is not None:
+            changes.append(change)
+    if (ui.configbool('hgbuildbot', 'coalesce', False) or
+        budget.exceeded is not None):
+        maxfiles = int(ui.config('hgbuildbot', 'max-files', MAX_FILES))
+        changes = coalesce(changes, maxfiles)
+
+    breakers = []
+    for master in masters:
+        breaker = hooksinks.Sink(ui, repo, 'buildbot', master)
+        if breaker.available():
+            breakers.append((master, breaker))
+    if not breakers:
+        return
 
     old_stdout = sys.stdout
     new_stdout = sys.stdout = StringIO()
     try:
-        for master in masters:
-            sendchanges(ui, master, changes)
+        pending = dict(breakers)
+
+        def done(res, master):
+            del pending[master]
+            # stop once every master has answered
+            if not pending:
+                reactor.stop()
+        for master, breaker in breakers:
+            d = sendchanges(ui, master, changes, breaker)
+            d.addBoth(done, master)
+        timeout = max(b.timeout for m, b in breakers)
+        timer = reactor.callLater(timeout, reactor.stop)
         reactor.run()
+        if timer.active():
+            timer.cancel()
+        for master, breaker in pending.items():
+            breaker.failed()
+            hookmetrics.incr('sink_failures', sink='buildbot', master=master)
+            print "change(s) NOT sent to %s, timed out after %ds" % (
+                master, timeout)
     finally:
         sys.stdout = old_stdout
         new_stdout.seek(0)
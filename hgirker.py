@@ -1,10 +1,20 @@
-from mercurial.node import bin, short
-from mercurial.templatefilters import person
+# Mercurial hooks are not run with the hook's directory in sys.path
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
+from mercurial.node import bin
 from mercurial import cmdutil, patch, templater, util, mail
 
-import os
 import json
 import socket
+import urllib
+
+import hookbudget
+import hookmetrics
+import hooktemplates
+import hooksinks
+import hooksnapshot
+import hookdaemon
 
 IRKER_HOST = 'localhost'
 IRKER_PORT = 6659
@@ -16,66 +26,147 @@ DEFTEMPLATE = '''%(bold)s%(project)s:%(bold)s \
 / %(files)s%(bold)s:%(bold)s %(logmsg)s \
 %(gray)s%(url)s%(reset)s'''
 
+# Changegroups of more than [irker] summary-threshold changesets are announced
+# with one summary message per branch instead of one message per changeset,
+# so that large pushes don't flood the channel.  Set it to 0 to disable.
+# The changesets left over once the hook's budget is exceeded are summarized
+# the same way, see hookbudget.py.
+SUMMARY_THRESHOLD = 20
+# authors listed by name in a summary
+SUMMARY_AUTHORS = 5
+
+SUMMARYTEMPLATE = '''%(bold)s%(project)s:%(bold)s \
+%(yellow)s%(branch)s%(reset)s \
+* %(bold)s%(count)d changesets%(bold)s \
+by %(green)s%(authors)s%(reset)s \
+/ %(bold)s%(first)s .. %(last)s%(bold)s \
+%(gray)s%(url)s%(reset)s'''
+
+COLORS = {
+    'bold': '\x02',
+    'green': '\x0303',
+    'blue': '\x0302',
+    'yellow': '\x0307',
+    'brown': '\x0305',
+    'gray': '\x0314',
+    'reset': '\x0F'
+}
+
 def getenv(ui, repo):
-    env = {
-        'bold': '\x02',
-        'green': '\x0303',
-        'blue': '\x0302',
-        'yellow': '\x0307',
-        'brown': '\x0305',
-        'gray': '\x0314',
-        'reset': '\x0F'
-    }
+    env = dict(COLORS)
+    env['ui'] = ui
     env['repo'] = repo
     env['project'] = ui.config('irker', 'project')
     if env['project'] is None:
         raise RuntimeError('missing irker.project config value')
     env['baseurl'] = ui.config('web', 'baseurl')
-    env['template'] = ui.config('irker', 'template', DEFTEMPLATE)
+    env['template'] = hooktemplates.get(ui, 'irker', 'template', DEFTEMPLATE,
+                                        style='percent')
     env['channels'] = ui.config('irker', 'channels')
     if env['channels'] is None:
         raise RuntimeError('missing irker.channels config value')
+    env['to'] = env['channels'].split(',')
+    env['summary-template'] = hooktemplates.get(
+        ui, 'irker', 'summary-template', SUMMARYTEMPLATE, style='percent')
+    env['summary-threshold'] = int(ui.config('irker', 'summary-threshold',
+                                             SUMMARY_THRESHOLD))
     return env
 
 def getfiles(env, ctx):
-    f = env['repo'].status(ctx.p1().node(), ctx.node())
-    elems = []
-    for path in f[0] + f[1] + f[2]:
-        elems.append(path)
+    modified, added, removed = hooksnapshot.get(env['repo']).status(ctx.rev())
+    elems = modified + added + removed
     pfx = os.path.commonprefix(elems)
     if len(elems) > 1 and pfx:
         return pfx + '(' + ' '.join(e[len(pfx):] for e in elems) + ')'
     return ' '.join(elems)
 
 def generate(env, ctx):
-    n = ctx.node()
-    ns = short(n)
-    d = env.copy()
-    d['branch'] = ctx.branch()
-    d['author'] = person(ctx.user())
-    d['rev'] = '%d:%s' % (ctx.rev(), ns)
-    logmsg = filter(None, ctx.description().splitlines())
+    rec = hooktemplates.record(env['ui'], env['repo'], ctx.rev())
+    d = {}
+    d['rev'] = '%d:%s' % (rec.rev, rec.short)
+    logmsg = filter(None, rec.description.splitlines())
     d['logmsg'] = ' '.join(logmsg[:4])
     if len(logmsg) > 4:
         d['logmsg'] += '...'
-    if env['baseurl']:
-        d['url'] = env['baseurl'].rstrip('/') + '/rev/%s' % ns
-    else:
-        d['url'] = ''
     d['files'] = getfiles(env, ctx)
     return json.dumps({
-        'to': env['channels'].split(','),
-        'privmsg': d['template'] % d,
+        'to': env['to'],
+        'privmsg': env['template'].render(d, rec, env),
     })
 
+def generate_summaries(env, start, end):
+    """Return one summary message per branch for revisions start..end-1.
+
+    Only changelog data is used, so this stays cheap for huge pushes.
+    """
+    snap = hooksnapshot.get(env['repo'])
+    branches = []
+    bybranch = {}
+    for rev in xrange(start, end):
+        r = snap[rev]
+        if r.branch not in bybranch:
+            branches.append(r.branch)
+            bybranch[r.branch] = []
+        bybranch[r.branch].append(rev)
+
+    msgs = []
+    for branch in branches:
+        revs = bybranch[branch]
+        first = hooktemplates.record(env['ui'], env['repo'], revs[0])
+        last = hooktemplates.record(env['ui'], env['repo'], revs[-1])
+        authors = []
+        for rev in revs:
+            author = hooktemplates.record(env['ui'], env['repo'], rev).author
+            if author not in authors:
+                authors.append(author)
+        names = ', '.join(authors[:SUMMARY_AUTHORS])
+        if len(authors) > SUMMARY_AUTHORS:
+            names += ' +%d more' % (len(authors) - SUMMARY_AUTHORS)
+        d = {
+            'branch': branch,
+            'count': len(revs),
+            'authors': names,
+            'first': '%d:%s' % (first.rev, first.short),
+            'last': '%d:%s' % (last.rev, last.short),
+        }
+        if env['baseurl']:
+            revset = '%s::%s and branch(%s)' % (first.short, last.short,
+                                                first.short)
+            d['url'] = (env['baseurl'].rstrip('/') + '/log?rev=' +
+                        urllib.quote(revset, safe=''))
+        else:
+            d['url'] = ''
+        msgs.append(json.dumps({
+            'to': env['to'],
+            'privmsg': env['summary-template'].render(d, env),
+        }))
+    return msgs
+
 def hook(ui, repo, hooktype, node=None, url=None, **kwds):
+    try:
+        _hook(ui, repo, hooktype, node, url, **kwds)
+    finally:
+        hookmetrics.flush(ui)
+
+def _hook(ui, repo, hooktype, node=None, url=None, **kwds):
+    breaker = hooksinks.Sink(ui, repo, 'irker',
+                             '%s:%d' % (IRKER_HOST, IRKER_PORT))
+
+    def _sendmsg(msg):
+        with hookmetrics.sink('irker'):
+            if hookdaemon.sendirker(ui, IRKER_HOST, IRKER_PORT, msg,
+                                    breaker.timeout):
+                return
+            sock = socket.create_connection((IRKER_HOST, IRKER_PORT),
+                                            breaker.timeout)
+            try:
+                sock.sendall(msg + "\n")
+            finally:
+                sock.close()
+
     def sendmsg(msg):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            sock.connect((IRKER_HOST, IRKER_PORT))
-            sock.sendall(msg + "\n")
-        finally:
-            sock.close()
+        if breaker.available():
+            breaker.call(_sendmsg, msg)
 
     env = getenv(ui, repo)
 
@@ -83,10 +174,24 @@ def hook(ui, repo, hooktype, node=None, url=None, **kwds):
     if hooktype == 'changegroup':
         start = repo.changelog.rev(n)
         end = len(repo.changelog)
+        hookmetrics.incr('changesets', end - start, hook='hgirker')
+        threshold = env['summary-threshold']
+        if threshold and end - start > threshold:
+            for msg in generate_summaries(env, start, end):
+                sendmsg(msg)
+            return
+        budget = hookbudget.Budget(ui, 'hgirker')
         for rev in xrange(start, end):
+            if not budget.check('changesets'):
+                budget.warn('only announcing a summary of the changesets '
+                            'from %d' % rev)
+                for msg in generate_summaries(env, rev, end):
+                    sendmsg(msg)
+                break
             n = repo.changelog.node(rev)
             ctx = repo.changectx(n)
             sendmsg(generate(env, ctx))
     else:
         ctx = repo.changectx(n)
+        hookmetrics.incr('changesets', hook='hgirker')
         sendmsg(generate(env, ctx))
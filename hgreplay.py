@@ -0,0 +1,275 @@
+"""
+Mercurial extension to replay the hooks over existing history.
+
+This runs the checks done by checkbranch.py and checkwhitespace.py, the issue
+extraction of hgroundup.py and the message rendering of mail.py, hgirker.py,
+hgroundup.py and hgbuildbot.py over a range of revisions, as if they had just
+been pushed.  Nothing is sent: every notifier sink is replaced by a local
+stand-in that only records the rendered messages.  The revisions are split
+into shards that are replayed by worker processes, and the result is written
+as a JSON report.  Since it does the same work as a real push, the report
+doubles as a throughput benchmark.
+
+To use it, enable the extension in the hgrc of the repository whose hook
+configuration should be tested (the [checkbranch], [irker], [hgroundup],
+[hgbuildbot], [mail] and [web] sections are picked up from there):
+
+[extensions]
+hgreplay = /home/hg/repos/hooks/hgreplay.py
+
+and run e.g.
+
+hg replayhooks -r 0:tip -j 8 -o replay.json
+"""
+
+# Mercurial hooks are not run with the hook's directory in sys.path
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
+import json
+import time
+import multiprocessing
+
+from mercurial.i18n import _
+from mercurial.node import hex
+from mercurial import hg, scmutil, util
+from mercurial import ui as uimod
+
+import checkbranch
+import checkwhitespace
+import hgroundup
+import hgirker
+import mail
+import hookpool
+import hooktemplates
+
+
+def loadbuildbot():
+    """Return the hgbuildbot module, or None if twisted is not installed
+    (it and buildbot are only needed to send changes)."""
+    try:
+        import hgbuildbot
+        # demandimport only really imports the module on first use
+        hgbuildbot.getfilter
+    except ImportError:
+        return None
+    return hgbuildbot
+
+# config sections that are copied from the parent ui to the workers
+SECTIONS = ('checkbranch', 'hgroundup', 'irker', 'hgbuildbot', 'mail',
+            'smtp', 'web', 'ui', 'diff')
+
+
+class LocalSink(object):
+    """Stand-in for a notification sink that records what would be sent."""
+
+    def __init__(self, name, keep=False):
+        self.name = name
+        self.keep = keep
+        self.count = 0
+        self.bytes = 0
+        self.messages = []
+
+    def send(self, rev, msg):
+        self.count += 1
+        self.bytes += len(msg)
+        if self.keep:
+            self.messages.append((rev, msg))
+
+    def report(self):
+        data = {'messages': self.count, 'bytes': self.bytes}
+        if self.keep:
+            data['rendered'] = self.messages
+        return data
+
+
+def _collect(ui, fn, *args):
+    """Call fn(*args) and return (result, captured ui output)."""
+    ui.pushbuffer(error=True)
+    try:
+        res = fn(*args)
+    finally:
+        out = ui.popbuffer()
+    return res, out
+
+
+def replayshard(root, config, revs, keep=False):
+    """Replay the hooks over 'revs' of the repository at 'root'.
+
+    Returns a JSON-serializable dict with the results for the shard.
+    """
+    ui = uimod.ui()
+    for section, name, value in config:
+        ui.setconfig(section, name, value)
+    repo = hg.repository(ui, root)
+    ui = repo.ui
+    mail.plain_output(ui)
+    hgbuildbot = loadbuildbot()
+
+    branches = ui.configlist('checkbranch', 'allow-branches')
+    repourl = ui.config('hgroundup', 'repourl')
+    if not repourl and ui.config('web', 'baseurl'):
+        repourl = ui.config('web', 'baseurl').rstrip('/') + '/rev/'
+    try:
+        irkerenv = hgirker.getenv(ui, repo)
+    except RuntimeError:
+        irkerenv = None
+    prefix = ui.config('hgbuildbot', 'prefix', '')
+    revurl = ui.config('hgbuildbot', 'rev_url', '')
+    if hgbuildbot is not None:
+        buildbotfilter = hgbuildbot.getfilter(ui)
+    template = hooktemplates.get(ui, 'hgroundup', 'template',
+                                 hgroundup.COMMENT_TEMPLATE)
+
+    sinks = {}
+    for name in ('mail', 'irker', 'roundup', 'buildbot'):
+        sinks[name] = LocalSink(name, keep)
+    timings = dict.fromkeys(['checkbranch', 'checkwhitespace', 'roundup',
+                             'mail', 'irker', 'buildbot'], 0.0)
+    failures = {'checkbranch': {}, 'checkwhitespace': {}}
+    issues = {}
+
+    def timed(name, fn, *args):
+        t = time.time()
+        try:
+            return fn(*args)
+        finally:
+            timings[name] += time.time() - t
+
+    for rev in revs:
+        ctx = repo[rev]
+        node = hex(ctx.node())
+
+        if branches:
+            bad, out = timed('checkbranch', _collect, ui,
+                             checkbranch.check_changeset, ui, ctx, branches)
+            if bad:
+                failures['checkbranch'][node] = out
+        # like check_whitespace_single, compare with the first parent only
+        p1 = ctx.p1().rev()
+        bad, out = timed('checkwhitespace', _collect, ui,
+                         checkwhitespace.compare_revisions,
+                         repo, ui, p1, rev)
+        if bad:
+            failures['checkwhitespace'][node] = out
+
+        t = time.time()
+        rec = hooktemplates.record(ui, repo, rev)
+        for data in hgroundup.extract_issues(rec.description):
+            issues.setdefault(data['issue_id'], []).append(
+                (rev, node, data['verb'] or ''))
+            if repourl:
+                sinks['roundup'].send(
+                    rev, hgroundup.make_comment(rec, repourl, template))
+        timings['roundup'] += time.time() - t
+
+        if irkerenv is not None:
+            msg = timed('irker', hgirker.generate, irkerenv, ctx)
+            sinks['irker'].send(rev, msg)
+
+        subj, body = timed('mail', mail.render, ui, repo, ctx)
+        sinks['mail'].send(rev, 'Subject: %s\n\n%s' % (subj, body))
+
+        if hgbuildbot is not None:
+            change = timed('buildbot', hgbuildbot.getchange,
+                           repo, rev, prefix, revurl, buildbotfilter)
+            if change is not None:
+                sinks['buildbot'].send(rev, json.dumps(change))
+
+    return {
+        'revs': len(revs),
+        'failures': failures,
+        'issues': issues,
+        'sinks': dict((k, v.report()) for k, v in sinks.iteritems()),
+        'timings': timings,
+    }
+
+
+def _replayshard(args):
+    return replayshard(*args)
+
+
+def merge(results):
+    """Merge the per-shard results into one report."""
+    report = {
+        'revs': 0,
+        'failures': {'checkbranch': {}, 'checkwhitespace': {}},
+        'issues': {},
+        'sinks': {},
+        'timings': {},
+    }
+    for res in results:
+        report['revs'] += res['revs']
+        for check, failed in res['failures'].iteritems():
+            report['failures'][check].update(failed)
+        for issue, refs in res['issues'].iteritems():
+            report['issues'].setdefault(issue, []).extend(refs)
+        for name, data in res['sinks'].iteritems():
+            total = report['sinks'].setdefault(
+                name, {'messages': 0, 'bytes': 0})
+            total['messages'] += data['messages']
+            total['bytes'] += data['bytes']
+            if 'rendered' in data:
+                total.setdefault('rendered', []).extend(data['rendered'])
+        for name, secs in res['timings'].iteritems():
+            report['timings'][name] = report['timings'].get(name, 0.0) + secs
+    for refs in report['issues'].itervalues():
+        refs.sort()
+    return report
+
+
+def replayhooks(ui, repo, **opts):
+    """replay the hooks over existing history
+
+    Runs the whitespace and branch checks, the Roundup issue extraction and
+    the notification renderers over the given revisions (default: all),
+    without sending anything, and writes a JSON report.
+    """
+    revs = sorted(scmutil.revrange(repo, opts['rev'] or ['0:tip']))
+    if not revs:
+        raise util.Abort(_('no revisions to replay'))
+    jobs = int(opts['jobs'] or multiprocessing.cpu_count())
+    config = []
+    for section in SECTIONS:
+        for name, value in ui.configitems(section):
+            config.append((section, name, value))
+    keep = bool(opts['messages'])
+    work = [(repo.root, config, shard, keep)
+            for shard in hookpool.shards(revs, jobs)]
+
+    start = time.time()
+    results = hookpool.run(_replayshard, work, jobs)
+    elapsed = time.time() - start
+
+    report = merge(results)
+    report['repo'] = repo.root
+    report['jobs'] = jobs
+    report['shards'] = len(work)
+    report['elapsed'] = elapsed
+    report['revs_per_sec'] = report['revs'] / elapsed if elapsed else 0.0
+
+    output = opts['output']
+    if output:
+        fp = open(output, 'w')
+        try:
+            json.dump(report, fp, indent=1, sort_keys=True)
+        finally:
+            fp.close()
+    ui.status(_('replayed %d revisions in %.1fs (%.1f revs/sec, %d jobs)\n')
+              % (report['revs'], elapsed, report['revs_per_sec'], jobs))
+    for check, failed in sorted(report['failures'].iteritems()):
+        ui.status(_('%s: %d failing changesets\n') % (check, len(failed)))
+    ui.status(_('%d issues referenced\n') % len(report['issues']))
+    for name, data in sorted(report['sinks'].iteritems()):
+        ui.status(_('%s: %d messages, %d bytes\n')
+                  % (name, data['messages'], data['bytes']))
+
+
+cmdtable = {
+    'replayhooks': (replayhooks,
+        [('r', 'rev', [], _('revisions to replay (default: 0:tip)'), _('REV')),
+         ('j', 'jobs', 0, _('number of worker processes'), _('N')),
+         ('o', 'output', '', _('write the JSON report to FILE'), _('FILE')),
+         ('', 'messages', None, _('include rendered messages in the report'))],
+        _('hg replayhooks [-r REV] [-j N] [-o FILE]')),
+}
@@ -23,23 +23,62 @@ To use this hook, include the following in hgrc:
     fromaddr = roundup-user@example.com
     toaddr = roundup-admin@example.com
 
+The comment added to the issue can be changed with a `template` property in
+the [hgroundup] section, using string.Template syntax; see COMMENT_TEMPLATE
+for the available fields.
+
 `fromaddr` must be registered as the address of an existing Roundup user,
 otherwise Roundup will refuse and bounce the message.
 Also, you need either a `baseurl` property in the [web] section,
 or a `repourl` property in the [hgroundup] section.
 
+The SMTP connection timeout and circuit breaker are configured in the
+[hooksinks] section, see hooksinks.py.  If a hook daemon is configured (see
+hookdaemon.py), the emails are sent through its connection pool.
+
+The hook also keeps an index of the issue references of all changesets in
+.hg/cache/hgroundup-issues.  To build it for existing history and query it,
+enable this file as an extension as well:
+
+    [extensions]
+    hgroundup = /home/hg/repos/hooks/hgroundup.py
+
+    [hgroundup]
+    index-catchup = 1000
+
+and run `hg roundup-index` once (it uses one worker process per CPU), then
+e.g. `hg roundup-lookup 12345`.  `hg roundup-lookup --resend 12345` sends
+the comments for the changesets referencing the issue to Roundup again, for
+instance after a failed update.  If the index lags behind by more than
+`index-catchup` revisions when a push comes in, the hook leaves it alone
+and `hg roundup-index` has to be run again.
+
 Initial implementation by Kelsey Hightower <kelsey.hightower@gmail.com>.
 """
+# Mercurial hooks are not run with the hook's directory in sys.path
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
 import re
+import fcntl
 import smtplib
 import posixpath
 import traceback
+import multiprocessing
 
-from string import Template
 from email.mime.text import MIMEText
 
-from mercurial.templatefilters import person
+from mercurial.i18n import _
+from mercurial.node import hex
 from mercurial.encoding import fromlocal
+from mercurial import hg, util
+from mercurial import ui as uimod
+
+import hookmetrics
+import hookpool
+import hooktemplates
+import hooksinks
+import hookdaemon
 
 VERBS = r'(?:\b(?P<verb>close[sd]?|closing|)\s+)?'
 ISSUE_PATTERN = re.compile(r'%s(?:#|\bissue|\bbug)\s*(?P<issue_id>[0-9]{4,})'
@@ -49,20 +88,20 @@ New changeset ${changeset_id} by $author in branch '${branch}':
 ${commit_msg}
 ${changeset_url}
 """
+INDEXFILE = 'cache/hgroundup-issues'
 
 
-def update_issue(*args, **kwargs):
+def update_issue(ui, *args, **kwargs):
     try:
-        _update_issue(*args, **kwargs)
+        _update_issue(ui, *args, **kwargs)
     except:
         traceback.print_exc()
         raise
+    finally:
+        hookmetrics.flush(ui)
 
-def _update_issue(ui, repo, node, **kwargs):
-    """Update a Roundup issue for corresponding changesets.
-
-    Return True if updating the Roundup issue fails, else False.
-    """
+def getconfig(ui):
+    """Return the (repourl, fromaddr, toaddr) configuration."""
     repourl = ui.config('hgroundup', 'repourl')
     if not repourl:
         repourl = posixpath.join(ui.config('web', 'baseurl'), 'rev/')
@@ -74,50 +113,110 @@ def _update_issue(ui, repo, node, **kwargs):
                 'roundup hook not configured properly,\nplease '
                 'set the "%s" property in the [hgroundup] section'
                 % var)
+    return repourl, fromaddr, toaddr
+
+def _update_issue(ui, repo, node, **kwargs):
+    """Update a Roundup issue for corresponding changesets.
+
+    Return True if updating the Roundup issue fails, else False.
+    """
+    repourl, fromaddr, toaddr = getconfig(ui)
     start = repo[node].rev()
+    template = hooktemplates.get(ui, 'hgroundup', 'template', COMMENT_TEMPLATE)
 
     issues = {}
+    entries = []
 
+    hookmetrics.incr('changesets', len(repo) - start, hook='hgroundup')
     for rev in xrange(start, len(repo)):
-        ctx = repo[rev]
-        description = fromlocal(ctx.description().strip())
-        matches = ISSUE_PATTERN.finditer(description)
-        ids = set()
-        for match in matches:
-            data = match.groupdict()
+        rec = hooktemplates.record(ui, repo, rev)
+        for data in extract_issues(rec.description):
             ui.debug('match in commit msg: %s\n' % data)
-            # check for duplicated issue numbers in the same commit msg
-            if data['issue_id'] in ids:
-                continue
-            ids.add(data['issue_id'])
-            comment = Template(COMMENT_TEMPLATE).substitute({
-                'author': fromlocal(person(ctx.user())),
-                'branch': ctx.branch(),
-                'changeset_id': str(ctx),
-                'changeset_url': posixpath.join(repourl, str(ctx)),
-                'commit_msg': description.splitlines()[0],
-            })
+            entries.append((data['issue_id'], rev, rec.node,
+                            data['verb'] or ''))
+            comment = make_comment(rec, repourl, template)
             add_comment(issues, data, comment)
+    updateindex(ui, repo, start, entries)
+    send_issues(ui, repo, fromaddr, toaddr, issues)
+    return False
+
+def send_issues(ui, repo, fromaddr, toaddr, issues):
+    """Send the comments collected in 'issues' to Roundup."""
     if issues:
         smtp_host = ui.config('smtp', 'host', default='localhost')
         smtp_port = int(ui.config('smtp', 'port', 25))
-        s = smtplib.SMTP(smtp_host, smtp_port)
-        username = ui.config('smtp', 'username', '')
-        if username:
-          password = ui.config('smtp', 'password', '')
-          s.login(username, password)
-        try:
-            send_comments(s, fromaddr, toaddr, issues)
-            ui.status("sent email to roundup at " + toaddr + '\n')
-        except Exception, err:
-            # make sure an issue updating roundup does not prevent an
-            # otherwise successful push.
-            ui.warn("sending email to roundup at %s failed: %s\n" %
-                    (toaddr, err))
+        breaker = hooksinks.Sink(ui, repo, 'smtp',
+                                 '%s:%d' % (smtp_host, smtp_port))
+        if not breaker.available():
+            return False
+        with hookmetrics.sink('smtp', hook='hgroundup') as timer:
+            username = ui.config('smtp', 'username', '')
+            password = ui.config('smtp', 'password', '')
+            pending = list(comment_messages(fromaddr, toaddr, issues))
+            try:
+                while pending:
+                    if not hookdaemon.sendmail(ui, smtp_host, smtp_port,
+                                               username, password, fromaddr,
+                                               toaddr, pending[0],
+                                               breaker.timeout):
+                        # no daemon, send the rest ourselves
+                        break
+                    pending.pop(0)
+            except Exception, err:
+                timer.failed()
+                breaker.failed()
+                ui.warn("sending email to roundup at %s failed: %s\n" %
+                        (toaddr, err))
+                return False
+            if not pending:
+                breaker.succeeded()
+                ui.status("sent email to roundup at " + toaddr + '\n')
+                return False
+            s = breaker.call(smtplib.SMTP, smtp_host, smtp_port,
+                             timeout=breaker.timeout)
+            if username:
+              s.login(username, password)
+            try:
+                send_comments(s, fromaddr, toaddr, pending)
+                ui.status("sent email to roundup at " + toaddr + '\n')
+            except Exception, err:
+                # make sure an issue updating roundup does not prevent an
+                # otherwise successful push.
+                timer.failed()
+                breaker.failed()
+                ui.warn("sending email to roundup at %s failed: %s\n" %
+                        (toaddr, err))
     else:
         ui.debug("no issues to send to roundup\n")
     return False
 
+def extract_issues(description):
+    """Return the issue references found in a commit message.
+
+    Each reference is the groupdict of an ISSUE_PATTERN match; only the
+    first mention of each issue number is kept.
+    """
+    found = []
+    ids = set()
+    for match in ISSUE_PATTERN.finditer(description):
+        data = match.groupdict()
+        # check for duplicated issue numbers in the same commit msg
+        if data['issue_id'] in ids:
+            continue
+        ids.add(data['issue_id'])
+        found.append(data)
+    return found
+
+def make_comment(rec, repourl, template=None):
+    """Render the Roundup comment for the changeset of Record 'rec'."""
+    if template is None:
+        template = hooktemplates.compile(COMMENT_TEMPLATE)
+    return template.render({
+        'changeset_id': rec.short,
+        'changeset_url': posixpath.join(repourl, rec.short),
+        'commit_msg': rec.summary,
+    }, rec)
+
 def add_comment(issues, data, comment):
     """Process a comment made in a commit message."""
     key = data['issue_id']
@@ -132,19 +231,201 @@ def add_comment(issues, data, comment):
             'stage': 'resolved',
         })
 
-def send_comments(s, fromaddr, toaddr, issues):
-    """Update the Roundup issue with a comment and changeset link."""
+def comment_messages(fromaddr, toaddr, issues):
+    """Generate the emails updating the Roundup issues."""
+    for issue_id, data in issues.iteritems():
+        props = ''
+        if data['properties']:
+            props = ' [%s]' % ';'.join('%s=%s' % x
+                                       for x in data['properties'].iteritems())
+        msg = MIMEText('\n\n'.join(data['comments']),
+                       _subtype='plain', _charset='utf8')
+        msg['From'] = fromaddr
+        msg['To'] = toaddr
+        msg['Subject'] = "[issue%s]%s" % (issue_id, props)
+        yield msg.as_string()
+
+def send_comments(s, fromaddr, toaddr, messages):
+    """Send the comment 'messages' (see comment_messages) to Roundup."""
     try:
-        for issue_id, data in issues.iteritems():
-            props = ''
-            if data['properties']:
-                props = ' [%s]' % ';'.join('%s=%s' % x
-                                           for x in data['properties'].iteritems())
-            msg = MIMEText('\n\n'.join(data['comments']),
-                           _subtype='plain', _charset='utf8')
-            msg['From'] = fromaddr
-            msg['To'] = toaddr
-            msg['Subject'] = "[issue%s]%s" % (issue_id, props)
-            s.sendmail(fromaddr, toaddr, msg.as_string())
+        for msg in messages:
+            s.sendmail(fromaddr, toaddr, msg)
     finally:
         s.quit()
+
+# --- issue index
+
+def readindex(repo):
+    """Read the issue index of 'repo'.
+
+    Returns ({issue_id: [(rev, hexnode, verb), ...]}, lastrev), where lastrev
+    is the last revision covered by the index, or (None, -1) if there is no
+    valid index (missing, or made stale by a strip).
+    """
+    try:
+        data = repo.opener.read(INDEXFILE)
+    except (IOError, OSError):
+        return None, -1
+    index = {}
+    pending = []
+    lastrev = -1
+    for line in data.splitlines():
+        fields = line.split(' ')
+        if fields[0] == '#':
+            # '# indexed REV NODE' closes each batch of entries
+            rev, node = int(fields[2]), fields[3]
+            if rev >= len(repo) or hex(repo.changelog.node(rev)) != node:
+                return None, -1
+            for issue_id, entry in pending:
+                index.setdefault(issue_id, []).append(entry)
+            pending = []
+            lastrev = rev
+        elif len(fields) == 4:
+            issue_id, rev, node, verb = fields
+            pending.append((issue_id, (int(rev), node, verb)))
+    if lastrev < 0:
+        return None, -1
+    return index, lastrev
+
+def _formatindex(entries, lastrev, lastnode):
+    lines = ['%s %d %s %s\n' % entry for entry in entries]
+    lines.append('# indexed %d %s\n' % (lastrev, lastnode))
+    return ''.join(lines)
+
+def lockindex(repo):
+    """Lock the issue index against the hooks of concurrent pushes, which
+    run after the repository lock is released.  Closing the returned file
+    releases the lock."""
+    fp = repo.opener(INDEXFILE + '.lock', 'a')
+    fcntl.flock(fp, fcntl.LOCK_EX)
+    return fp
+
+def updateindex(ui, repo, start, entries):
+    """Append the issue references of revisions start..tip to the index.
+
+    'entries' are the (issue_id, rev, hexnode, verb) references found in
+    those revisions.  Revisions missing between the index and 'start' are
+    scanned first, unless there are more than [hgroundup] index-catchup.
+    """
+    lock = lockindex(repo)
+    try:
+        _updateindex(ui, repo, start, entries)
+    finally:
+        lock.close()
+
+def _updateindex(ui, repo, start, entries):
+    index, lastrev = readindex(repo)
+    if index is None:
+        ui.debug('no roundup issue index, run "hg roundup-index"\n')
+        return
+    if lastrev >= len(repo) - 1:
+        return
+    if lastrev < start - 1:
+        catchup = int(ui.config('hgroundup', 'index-catchup', 1000))
+        if start - 1 - lastrev > catchup:
+            ui.debug('roundup issue index is %d revisions behind, '
+                     'run "hg roundup-index"\n' % (start - 1 - lastrev))
+            return
+        entries = scanrevs(repo, xrange(lastrev + 1, start)) + entries
+    else:
+        # the index already covers part of the changegroup
+        entries = [e for e in entries if e[1] > lastrev]
+    tip = len(repo) - 1
+    fp = repo.opener(INDEXFILE, 'a')
+    try:
+        fp.write(_formatindex(entries, tip, hex(repo.changelog.node(tip))))
+    finally:
+        fp.close()
+
+def scanrevs(repo, revs):
+    """Return the (issue_id, rev, hexnode, verb) references in 'revs'."""
+    changelog = repo.changelog
+    entries = []
+    for rev in revs:
+        node = changelog.node(rev)
+        description = fromlocal(changelog.read(node)[4])
+        for data in extract_issues(description):
+            entries.append((data['issue_id'], rev, hex(node),
+                            data['verb'] or ''))
+    return entries
+
+def _scanshard(args):
+    root, revs = args
+    repo = hg.repository(uimod.ui(), root)
+    return scanrevs(repo, revs)
+
+def buildindex(ui, repo, jobs=None):
+    """Rebuild the issue index of 'repo' from scratch, scanning revision
+    shards in 'jobs' worker processes."""
+    jobs = jobs or multiprocessing.cpu_count()
+    end = len(repo)
+    if not end:
+        raise util.Abort(_('empty repository'))
+    work = [(repo.root, shard)
+            for shard in hookpool.shards(xrange(end), jobs)]
+    results = hookpool.run(_scanshard, work, jobs)
+    entries = []
+    for shard in results:
+        entries.extend(shard)
+    lock = lockindex(repo)
+    try:
+        fp = repo.opener(INDEXFILE, 'w', atomictemp=True)
+        fp.write(_formatindex(entries, end - 1,
+                              hex(repo.changelog.node(end - 1))))
+        fp.close()
+    finally:
+        lock.close()
+    return len(entries)
+
+def lookup(repo, issue_id):
+    """Return the (rev, hexnode, verb) references to issue 'issue_id'.
+
+    Raises util.Abort if the repository has no valid index."""
+    index, lastrev = readindex(repo)
+    if index is None:
+        raise util.Abort(_('no roundup issue index, run "hg roundup-index"'))
+    return index.get(str(issue_id), [])
+
+def roundupindex(ui, repo, **opts):
+    """build the index of Roundup issue references
+
+    Scans the whole history for issue references (in parallel worker
+    processes) and writes them to .hg/cache/hgroundup-issues, which the
+    roundup hook then keeps up to date.
+    """
+    jobs = int(opts['jobs'] or 0)
+    count = buildindex(ui, repo, jobs)
+    ui.status(_('indexed %d issue references in %d revisions\n')
+              % (count, len(repo)))
+
+def rounduplookup(ui, repo, *issue_ids, **opts):
+    """show the changesets referencing Roundup issues
+
+    With --resend, send the comments for those changesets to Roundup again.
+    """
+    if not issue_ids:
+        raise util.Abort(_('no issue given'))
+    issues = {}
+    if opts['resend']:
+        repourl, fromaddr, toaddr = getconfig(ui)
+        template = hooktemplates.get(ui, 'hgroundup', 'template',
+                                     COMMENT_TEMPLATE)
+    for issue_id in issue_ids:
+        issue_id = issue_id.lstrip('#').lower().replace('issue', '')
+        for rev, node, verb in lookup(repo, issue_id):
+            ui.write('issue%s %d:%s %s\n' % (issue_id, rev, node[:12], verb))
+            if opts['resend']:
+                rec = hooktemplates.record(ui, repo, rev)
+                add_comment(issues, {'issue_id': issue_id, 'verb': verb},
+                            make_comment(rec, repourl, template))
+    if issues:
+        send_issues(ui, repo, fromaddr, toaddr, issues)
+
+cmdtable = {
+    'roundup-index': (roundupindex,
+        [('j', 'jobs', 0, _('number of worker processes'), _('N'))],
+        _('hg roundup-index [-j N]')),
+    'roundup-lookup': (rounduplookup,
+        [('', 'resend', None, _('send the comments to Roundup again'))],
+        _('hg roundup-lookup [--resend] ISSUE...')),
+}
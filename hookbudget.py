@@ -0,0 +1,122 @@
+"""
+Time, memory and size budgets for the Mercurial hooks.
+
+A pathological push (a vendor import with a huge diff, or tens of thousands
+of files) must not keep a hook busy for minutes or let it eat the memory of
+the server.  Each hook invocation gets a Budget and checks it at its natural
+checkpoints: per changeset, per file and per diff chunk.  Once a budget is
+exceeded it stays exceeded for the rest of the invocation, and the hook
+degrades in a defined way instead of doing the full work:
+
+  mail.py            diffs are truncated; in the changegroup hook, the
+                     changesets left over are only listed in one summary
+                     message per list
+  checkwhitespace.py only one in `sample` of the remaining files is checked,
+                     with a warning
+  hgbuildbot.py      only the last changeset of each branch is sent for the
+                     changesets left over, coalesced with the others
+  hgirker.py         the changesets left over are announced with one
+                     summary per branch
+
+Budgets are set in the [hooks-budget] section, either for all hooks or for
+one hook by prefixing its name; 0 or no value means no limit, which is the
+default for all of them:
+
+[hooks-budget]
+# seconds of wall time per hook invocation
+time = 120
+# resident memory the hook may add to the process, in megabytes
+memory = 2048
+# counters checked by the hooks
+mail.diff-bytes = 10485760
+mail.changesets = 200
+checkwhitespace.files = 5000
+checkwhitespace.sample = 10
+hgbuildbot.changesets = 1000
+hgirker.changesets = 100
+
+The counters only depend on the push, so the degradation they cause is
+deterministic; time and memory are only looked at in the same checkpoints.
+Memory is measured against the resident size of the process when the hook
+started, so that a long-lived server is not held to what an earlier request
+used.  It is read from /proc/self/statm; where there is none, the memory
+budget is not enforced.
+"""
+
+import os
+import time
+
+import hookmetrics
+
+SECTION = 'hooks-budget'
+
+
+def currentmemory():
+    """Return the resident memory of the process in kilobytes, or None if
+    it cannot be found out."""
+    try:
+        fp = open('/proc/self/statm')
+        try:
+            pages = int(fp.read().split()[1])
+        finally:
+            fp.close()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * (os.sysconf('SC_PAGE_SIZE') // 1024)
+
+
+class Budget(object):
+    """The budget of one invocation of 'hook', e.g. Budget(ui, 'mail')."""
+
+    def __init__(self, ui, hook):
+        self.ui = ui
+        self.hook = hook
+        self.start = time.time()
+        self.basememory = currentmemory()
+        self.used = {}
+        # why the budget was exceeded, None while it is not
+        self.exceeded = None
+
+    def limit(self, name, default=0):
+        """Return the hgrc value of 'name' for this hook, as a number."""
+        value = self.ui.config(SECTION, '%s.%s' % (self.hook, name))
+        if value is None:
+            value = self.ui.config(SECTION, name, default)
+        return float(value)
+
+    def check(self, name=None, amount=1):
+        """Checkpoint: add 'amount' to counter 'name', if given, and check
+        it, the time and the memory against their limits.
+
+        Return True while the hook is within its budget.
+        """
+        if name is not None:
+            self.used[name] = self.used.get(name, 0) + amount
+        if self.exceeded is not None:
+            return False
+        reason = None
+        if name is not None:
+            limit = self.limit(name)
+            if limit and self.used[name] > limit:
+                reason = '%s over %d' % (name, limit)
+        if reason is None:
+            limit = self.limit('time')
+            if limit and time.time() - self.start > limit:
+                reason = 'time over %ds' % limit
+        if reason is None and self.basememory is not None:
+            limit = self.limit('memory')
+            if limit:
+                used = currentmemory()
+                if used is not None and used - self.basememory > limit * 1024:
+                    reason = 'memory over %dMB' % limit
+        if reason is not None:
+            self.exceeded = reason
+            hookmetrics.incr('budget_exceeded', hook=self.hook,
+                             budget=reason.split()[0])
+            self.ui.debug('%s: budget exceeded: %s\n' % (self.hook, reason))
+        return reason is None
+
+    def warn(self, what):
+        """Tell the pusher about degradation 'what'."""
+        self.ui.warn('%s: %s, hook budget exceeded (%s)\n'
+                     % (self.hook, what, self.exceeded))
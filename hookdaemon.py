@@ -0,0 +1,306 @@
+#! /usr/bin/env python
+"""
+Long-lived worker process for the Mercurial hooks.
+
+hookdaemon [-t TIMEOUT] SOCKET
+
+Every hook invocation pays for its imports and opens its own network
+connections.  This daemon hosts the expensive parts instead: the whitespace
+checker of checkwhitespace.py (with a cache of the contents already checked)
+and the SMTP and irkerd senders of mail.py, hgroundup.py and hgirker.py
+(with pooled connections).  It listens on a Unix domain socket, so the warm
+caches and connections are shared by all the repositories and pushes on the
+host.  The buildbot hook is not hosted, since it needs its own Twisted
+reactor.
+
+The hooks use the daemon if the socket is configured in the hgrc:
+
+[hookdaemon]
+socket = /var/run/hghooks/hooks.sock
+timeout = 60
+
+If the socket is not configured, nobody is listening on it or the daemon
+goes away before it replies, the hooks do their work in-process as before.
+
+The protocol is one JSON object per line in each direction: a request is
+{"op": NAME, "args": {...}}, a reply either {"result": ...} or
+{"error": MESSAGE}.  Strings carrying raw bytes (file contents, messages)
+are sent latin-1 decoded.
+"""
+
+# Mercurial hooks are not run with the hook's directory in sys.path
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
+import json
+import socket
+import hashlib
+import smtplib
+import threading
+import SocketServer
+
+# number of checked (path, content hash) pairs the daemon remembers
+CACHESIZE = 100000
+
+
+class DaemonError(Exception):
+    """The daemon was reached, but failed to do the requested work."""
+
+
+class DaemonLost(Exception):
+    """The connection to the daemon failed after it was reached, so the
+    requested work may or may not have been done."""
+
+
+# --- client side, used by the hooks
+
+def call(ui, op, **args):
+    """Ask the daemon to run 'op' with keyword arguments 'args'.
+
+    Return the reply as a dict, or None if no daemon is available, in which
+    case the caller should do the work itself.  Raises DaemonError if the
+    daemon reported an error, and DaemonLost if it could not be heard from
+    after connecting.
+    """
+    path = ui.config('hookdaemon', 'socket')
+    if not path:
+        return None
+    timeout = float(ui.config('hookdaemon', 'timeout', 60))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error, err:
+            ui.debug('hookdaemon: not available at %s: %s\n' % (path, err))
+            return None
+        try:
+            sock.sendall(json.dumps({'op': op, 'args': args}) + '\n')
+            fp = sock.makefile('rb')
+            try:
+                line = fp.readline()
+            finally:
+                fp.close()
+        except socket.error, err:
+            raise DaemonLost('%s: %s' % (op, err))
+    finally:
+        sock.close()
+    if not line:
+        raise DaemonLost('%s: no reply' % op)
+    try:
+        resp = json.loads(line)
+    except ValueError:
+        raise DaemonLost('%s: garbled reply' % op)
+    if 'error' in resp:
+        raise DaemonError(resp['error'])
+    return resp
+
+
+def trycall(ui, op, **args):
+    """Like call(), but also return None if the daemon is lost, so that the
+    caller does the work itself.
+
+    Only for work that may be done twice: the daemon may have done it
+    before it went away.
+    """
+    try:
+        return call(ui, op, **args)
+    except DaemonLost, err:
+        ui.warn('hookdaemon: lost the daemon (%s), working in-process\n'
+                % err)
+        return None
+
+
+def sendmail(ui, host, port, username, password, sender, to, msg, timeout):
+    """Send 'msg' through the daemon's SMTP pool.
+
+    Return False if no daemon is available.  A message that was being sent
+    when the daemon was lost is sent again by the caller, a duplicate being
+    better than a lost message.  Errors of the SMTP server itself are raised
+    as DaemonError."""
+    return trycall(ui, 'smtp', host=host, port=port, username=username,
+                password=password, sender=sender, to=to,
+                msg=msg.decode('latin-1'), timeout=timeout) is not None
+
+
+def sendirker(ui, host, port, msg, timeout):
+    """Send 'msg' through the daemon's irkerd connection.
+
+    Return False if no daemon is available, see sendmail()."""
+    return trycall(ui, 'irker', host=host, port=port,
+                msg=msg.decode('latin-1'), timeout=timeout) is not None
+
+
+# --- server side
+
+class SMTPPool(object):
+    """Open SMTP connections, one per (host, port, username)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conns = {}
+
+    def _connect(self, host, port, username, password, timeout):
+        smtp = smtplib.SMTP(host, port, timeout=timeout)
+        if username:
+            smtp.login(username, password)
+        return smtp
+
+    def send(self, host, port, username, password, sender, to, msg,
+             timeout):
+        msg = msg.encode('latin-1')
+        key = (host, port, username)
+        with self.lock:
+            smtp = self.conns.pop(key, None)
+        if smtp is not None:
+            try:
+                if smtp.noop()[0] != 250:
+                    smtp.close()
+                    smtp = None
+            except smtplib.SMTPException:
+                smtp = None
+            except socket.error:
+                smtp = None
+        if smtp is None:
+            smtp = self._connect(host, port, username, password, timeout)
+        try:
+            smtp.sendmail(sender, to, msg)
+        except:
+            smtp.close()
+            raise
+        with self.lock:
+            old = self.conns.pop(key, None)
+            self.conns[key] = smtp
+        if old is not None:
+            old.close()
+
+
+class IrkerPool(object):
+    """Open connections to irkerd, which accepts any number of messages
+    per connection."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conns = {}
+
+    def send(self, host, port, msg, timeout):
+        msg = msg.encode('latin-1')
+        key = (host, port)
+        with self.lock:
+            sock = self.conns.pop(key, None)
+            if sock is not None:
+                try:
+                    sock.sendall(msg + '\n')
+                except socket.error:
+                    sock.close()
+                    sock = None
+            if sock is None:
+                sock = socket.create_connection((host, port), timeout)
+                try:
+                    sock.sendall(msg + '\n')
+                except:
+                    sock.close()
+                    raise
+            self.conns[key] = sock
+
+
+class WhitespaceCache(object):
+    """Results of checkwhitespace.check_content, by path and content."""
+
+    def __init__(self, size=CACHESIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.results = {}
+
+    def check(self, path, data):
+        import checkwhitespace
+        data = data.encode('latin-1')
+        key = (path, hashlib.sha1(data).digest())
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+        result = checkwhitespace.check_content(path, data)
+        with self.lock:
+            if len(self.results) >= self.size:
+                self.results.clear()
+            self.results[key] = result
+        return result
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, timeout):
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.clienttimeout = timeout
+        self.smtp = SMTPPool()
+        self.irker = IrkerPool()
+        self.whitespace = WhitespaceCache()
+        self.ops = {
+            'whitespace': self.whitespace.check,
+            'smtp': self.smtp.send,
+            'irker': self.irker.send,
+        }
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        self.request.settimeout(self.server.clienttimeout)
+        while True:
+            # not 'for line in self.rfile', which reads ahead and would
+            # wait for more than the single request the client sends
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                req = json.loads(line)
+                op = self.server.ops.get(req['op'])
+                if op is None:
+                    raise ValueError('unknown operation %r' % req['op'])
+                args = dict((str(k), v) for k, v in req['args'].iteritems())
+                resp = {'result': op(**args)}
+            except Exception, err:
+                resp = {'error': '%s: %s' % (err.__class__.__name__, err)}
+            self.wfile.write(json.dumps(resp) + '\n')
+            self.wfile.flush()
+
+
+def usage(msg=None):
+    if msg is not None:
+        print >> sys.stderr, msg
+    print >> sys.stderr, __doc__
+
+
+def main():
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "t:h", ["timeout=", "help"])
+    except getopt.error, msg:
+        usage(msg)
+        return 2
+    timeout = 60.0
+    for o, a in opts:
+        if o in ('-t', '--timeout'):
+            timeout = float(a)
+        elif o in ('-h', '--help'):
+            usage()
+            return 0
+    if len(args) != 1:
+        usage('exactly one socket path expected')
+        return 2
+    path = args[0]
+    if os.path.exists(path):
+        # a stale socket from a previous run
+        os.unlink(path)
+    os.umask(077)
+    server = Server(path, timeout)
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+Counters and latency histograms shared by the Mercurial hooks.
+
+The hooks record what they do (changesets processed, files checked, bytes of
+diff rendered, cache hits) and how long their notification sinks take (SMTP,
+irkerd, buildbot) in a process-wide registry.  flush() hands the collected
+values to a statsd daemon over UDP and/or merges them into a node-exporter
+textfile, then resets the registry.  Neither ever blocks the push: the UDP
+socket is non-blocking and errors are only reported with ui.debug.
+
+To enable either exporter, add something like the following to your hgrc:
+
+[hookmetrics]
+statsd = localhost:8125
+prefix = hg.hooks
+textfile = /var/lib/node_exporter/textfile/hghooks.prom
+"""
+
+import os
+import re
+import errno
+import fcntl
+import time
+import socket
+import tempfile
+
+from mercurial import util
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+PROM_PREFIX = 'hg_hooks_'
+
+_counters = {}
+_histograms = {}
+# textfile samples not written yet because the file was locked
+_unwritten = {}
+# resolved statsd addresses, by their hgrc value
+_addresses = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    """Add 'value' to counter 'name'."""
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Record a latency of 'seconds' in histogram 'name'."""
+    key = _key(name, labels)
+    hist = _histograms.get(key)
+    if hist is None:
+        # one count per bucket, then +Inf, sum and raw samples
+        hist = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, []]
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            hist[0][i] += 1
+    hist[0][-1] += 1
+    hist[1] += seconds
+    hist[2].append(seconds)
+
+
+class sink(object):
+    """Context manager timing one send to a notification sink.
+
+    The latency is recorded in the '<sink>_send_seconds' histogram; if the
+    block raises or calls failed(), 'sink_failures' is incremented for that
+    sink as well.
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        self.failure = False
+        return self
+
+    def failed(self):
+        """Count a failure that was handled inside the block."""
+        self.failure = True
+
+    def __exit__(self, exc_type, exc_value, tb):
+        observe('%s_send_seconds' % self.name, time.time() - self.start,
+                **self.labels)
+        if exc_type is not None or self.failure:
+            incr('sink_failures', sink=self.name, **self.labels)
+        return False
+
+
+def reset():
+    _counters.clear()
+    _histograms.clear()
+
+
+def _statsdname(prefix, name, labels):
+    parts = [name] + [v for k, v in labels]
+    parts = [re.sub(r'[^\w-]', '_', str(p)) for p in parts]
+    if prefix:
+        parts.insert(0, prefix)
+    return '.'.join(parts)
+
+
+def statsd_lines(prefix):
+    """Return the registry as a list of statsd protocol lines."""
+    lines = []
+    for (name, labels), value in sorted(_counters.iteritems()):
+        lines.append('%s:%d|c' % (_statsdname(prefix, name, labels), value))
+    for (name, labels), hist in sorted(_histograms.iteritems()):
+        stat = _statsdname(prefix, name, labels)
+        for seconds in hist[2]:
+            lines.append('%s:%.3f|ms' % (stat, seconds * 1000))
+    return lines
+
+
+def _promlabels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in items)
+
+
+def prom_samples():
+    """Return the registry as a {sample name: value} dict in the Prometheus
+    text format naming scheme."""
+    samples = {}
+    for (name, labels), value in _counters.iteritems():
+        samples[PROM_PREFIX + name + '_total' + _promlabels(labels)] = value
+    for (name, labels), hist in _histograms.iteritems():
+        base = PROM_PREFIX + name
+        for bound, count in zip(BUCKETS + ('+Inf',), hist[0]):
+            le = bound if bound == '+Inf' else repr(bound)
+            samples[base + '_bucket' + _promlabels(labels, [('le', le)])] = count
+        samples[base + '_sum' + _promlabels(labels)] = hist[1]
+        samples[base + '_count' + _promlabels(labels)] = hist[0][-1]
+    return samples
+
+
+def _readtextfile(path):
+    samples = {}
+    try:
+        fp = open(path)
+    except IOError:
+        return samples
+    try:
+        for line in fp:
+            if not line.strip() or line.startswith('#'):
+                continue
+            sample, value = line.rsplit(None, 1)
+            samples[sample] = float(value)
+    finally:
+        fp.close()
+    return samples
+
+
+def write_textfile(path):
+    """Merge the registry into the node-exporter textfile at 'path'.
+
+    All exported values are cumulative, so they are added to the values
+    already in the file; the file is replaced atomically.  Concurrent pushes
+    run in separate processes, so the read-modify-write is done under an
+    exclusive lock on 'path'.lock.  The push is never kept waiting for the
+    lock: if it is taken, the samples are kept for the next write and False
+    is returned.
+    """
+    for sample, value in prom_samples().iteritems():
+        _unwritten[sample] = _unwritten.get(sample, 0) + value
+    lockfp = open(path + '.lock', 'a')
+    try:
+        try:
+            fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, err:
+            if err.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+            return False
+        _mergetextfile(path)
+    finally:
+        # closing releases the lock
+        lockfp.close()
+    _unwritten.clear()
+    return True
+
+
+def _mergetextfile(path):
+    samples = _readtextfile(path)
+    for sample, value in _unwritten.iteritems():
+        samples[sample] = samples.get(sample, 0) + value
+    fd, tmp = tempfile.mkstemp(prefix='.hookmetrics-',
+                               dir=os.path.dirname(path) or '.')
+    fp = os.fdopen(fd, 'w')
+    try:
+        for sample in sorted(samples):
+            value = samples[sample]
+            if value == int(value):
+                value = int(value)
+            fp.write('%s %s\n' % (sample, value))
+    finally:
+        fp.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+
+
+def statsd_address(spec):
+    """Return the (ip, port) of the statsd daemon at 'spec' (host:port),
+    looking the host up only once per process."""
+    address = _addresses.get(spec)
+    if address is None:
+        host, port = spec.rsplit(':', 1)
+        address = (socket.gethostbyname(host), int(port))
+        _addresses[spec] = address
+    return address
+
+
+def send_statsd(address, prefix):
+    """Send the registry to the statsd daemon at (host, port) over UDP."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    try:
+        packet = []
+        size = 0
+        for line in statsd_lines(prefix):
+            # keep datagrams below the usual 1432 byte statsd limit
+            if packet and size + len(line) + 1 > 1400:
+                sock.sendto('\n'.join(packet), address)
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            sock.sendto('\n'.join(packet), address)
+    finally:
+        sock.close()
+
+
+def flush(ui):
+    """Export the registry as configured in [hookmetrics] and reset it."""
+    try:
+        statsd = ui.config('hookmetrics', 'statsd')
+        if statsd:
+            prefix = ui.config('hookmetrics', 'prefix', 'hg.hooks')
+            try:
+                send_statsd(statsd_address(statsd), prefix)
+            except (socket.error, ValueError), err:
+                ui.debug('hookmetrics: sending to statsd failed: %s\n' % err)
+        textfile = ui.config('hookmetrics', 'textfile')
+        if textfile:
+            try:
+                if not write_textfile(util.expandpath(textfile)):
+                    ui.debug('hookmetrics: %s is locked, writing it on the '
+                             'next flush\n' % textfile)
+            except (IOError, OSError, ValueError), err:
+                ui.debug('hookmetrics: writing %s failed: %s\n'
+                         % (textfile, err))
+    finally:
+        reset()
@@ -0,0 +1,37 @@
+"""
+Worker processes for the commands that go over the whole history.
+
+hgreplay.py (replayhooks) and hgroundup.py (roundup-index) split the
+revisions into contiguous shards and hand them to a multiprocessing pool.
+The pool is closed and joined when the work is done: terminating it would
+send SIGTERM to workers that inherited hg's catchterm handler, which makes
+each of them print a traceback.
+"""
+
+import multiprocessing
+
+
+def shards(revs, jobs):
+    """Split 'revs' into contiguous shards, a few per job."""
+    revs = list(revs)
+    count = max(1, min(len(revs), jobs * 4))
+    size = (len(revs) + count - 1) // count
+    return [revs[i:i + size] for i in xrange(0, len(revs), size)]
+
+
+def run(fn, work, jobs):
+    """Return map(fn, work), computed by 'jobs' worker processes.
+
+    'fn' must be a module-level function, so that it can be pickled.
+    """
+    if jobs == 1:
+        return map(fn, work)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(fn, work)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
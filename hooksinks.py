@@ -0,0 +1,142 @@
+"""
+Timeouts and a circuit breaker for the external notification sinks.
+
+Every send to an SMTP relay (mail.py, hgroundup.py), irkerd (hgirker.py) or
+a buildbot master (hgbuildbot.py) goes through a Sink, which supplies the
+connect/IO timeout for that kind of sink and keeps track of failures.  After
+`failures` consecutive failures the circuit opens: later pushes skip the sink
+straight away, saying so, instead of waiting for the timeout again.  Once
+`retry` seconds have passed, one push is let through as a probe; if it
+succeeds the circuit closes again, otherwise it stays open for another
+`retry` seconds.
+
+The state is kept in .hg/cache/hooksinks so that it survives between pushes.
+The defaults can be changed in the hgrc:
+
+[hooksinks]
+smtp.timeout = 10
+irker.timeout = 5
+buildbot.timeout = 30
+failures = 3
+retry = 300
+"""
+
+import json
+import time
+
+STATEFILE = 'cache/hooksinks'
+
+# default connect/IO timeouts, in seconds
+TIMEOUTS = {
+    'smtp': 10.0,
+    'irker': 5.0,
+    'buildbot': 30.0,
+}
+
+
+class SinkUnavailable(Exception):
+    """Raised instead of calling a sink whose circuit is open."""
+
+
+def _readstate(repo):
+    try:
+        return json.loads(repo.opener.read(STATEFILE))
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _writestate(repo, state):
+    try:
+        fp = repo.opener(STATEFILE, 'w', atomictemp=True)
+        fp.write(json.dumps(state, sort_keys=True))
+        fp.close()
+    except (IOError, OSError):
+        # a read-only cache only costs us the breaker
+        pass
+
+
+class Sink(object):
+    """One external sink, e.g. Sink(ui, repo, 'smtp', 'mail.example.org:25').
+
+    Use call() to send through the breaker, or available(), succeeded() and
+    failed() directly when the send is asynchronous.
+    """
+
+    def __init__(self, ui, repo, kind, target=''):
+        self.ui = ui
+        self.repo = repo
+        self.kind = kind
+        self.key = target and '%s:%s' % (kind, target) or kind
+        self.timeout = float(ui.config('hooksinks', kind + '.timeout',
+                                       TIMEOUTS.get(kind, 10.0)))
+        self.maxfailures = int(ui.config('hooksinks', 'failures', 3))
+        self.retry = float(ui.config('hooksinks', 'retry', 300))
+        # decided once per Sink, so a probe is not refused by its own check
+        self.allowed = None
+
+    def _state(self):
+        return _readstate(self.repo).get(self.key, {})
+
+    def _update(self, entry):
+        state = _readstate(self.repo)
+        if entry:
+            state[self.key] = entry
+        else:
+            state.pop(self.key, None)
+        _writestate(self.repo, state)
+
+    def available(self):
+        """Return True if the sink may be called (circuit closed, or open
+        long enough to let a probe through)."""
+        if self.allowed is None:
+            self.allowed = self._check()
+        return self.allowed
+
+    def _check(self):
+        entry = self._state()
+        opened = entry.get('opened')
+        if opened is None:
+            return True
+        wait = opened + self.retry - time.time()
+        if wait <= 0:
+            self.ui.debug('hooksinks: probing %s\n' % self.key)
+            # only one probe per retry period
+            entry['opened'] = time.time()
+            self._update(entry)
+            return True
+        self.ui.warn('hooksinks: skipping %s, it failed %d times in a '
+                     'row (next try in %ds)\n'
+                     % (self.key, entry.get('failures', 0), wait))
+        return False
+
+    def succeeded(self):
+        if self._state():
+            self.ui.debug('hooksinks: %s is back\n' % self.key)
+            self._update(None)
+
+    def failed(self):
+        entry = self._state()
+        entry['failures'] = entry.get('failures', 0) + 1
+        if entry['failures'] >= self.maxfailures:
+            if entry.get('opened') is None:
+                self.ui.warn('hooksinks: %s failed %d times in a row, '
+                             'skipping it for %ds\n'
+                             % (self.key, entry['failures'], self.retry))
+            entry['opened'] = time.time()
+            self.allowed = False
+        self._update(entry)
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) through the breaker.
+
+        Raises SinkUnavailable without calling fn if the circuit is open.
+        """
+        if not self.available():
+            raise SinkUnavailable(self.key)
+        try:
+            res = fn(*args, **kwargs)
+        except Exception:
+            self.failed()
+            raise
+        self.succeeded()
+        return res
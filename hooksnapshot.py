@@ -0,0 +1,105 @@
+"""
+Shared snapshot of the changesets of a push, for the notification hooks.
+
+mail.py, hgirker.py, hgroundup.py and hgbuildbot.py all need the same data
+about every new changeset: user, description, branch, parents and the files
+changed relative to the first parent.  Instead of each hook reading the
+changelog and running repo.status() again, the first hook to ask builds a
+compact Revision record, and the later hooks of the same push read it from
+the snapshot.
+
+A snapshot is kept on the repository object, and is only valid while the
+repository is unchanged: as soon as the tip moves, a new one is started.
+A snapshot started during the transaction of a push (by a pretxnchangegroup
+hook) is dropped once the changegroup and incoming hooks of the push have
+run, so that a long-lived server does not hold the records of a large push;
+otherwise it goes away with the repository object.  Records are built
+lazily, so incoming hooks, which see one changeset at a time, share them
+just like changegroup hooks do.
+"""
+
+import weakref
+
+from mercurial.node import nullrev
+
+import hookmetrics
+
+
+class Revision(object):
+    """The changelog data of one changeset."""
+
+    __slots__ = ('rev', 'node', 'manifest', 'user', 'date', 'files',
+                 'description', 'branch', 'extra', 'parents', 'status')
+
+    def __init__(self, changelog, rev):
+        self.rev = rev
+        self.node = changelog.node(rev)
+        (self.manifest, self.user, self.date, self.files, self.description,
+         self.extra) = changelog.read(self.node)
+        self.branch = self.extra.get('branch', 'default')
+        self.parents = [p for p in changelog.parentrevs(rev) if p != nullrev]
+        # (modified, added, removed) relative to the first parent,
+        # computed on first use
+        self.status = None
+
+
+class Snapshot(object):
+
+    def __init__(self, repo):
+        # the repository keeps its snapshot, not the other way round
+        self._repo = weakref.ref(repo)
+        self.tip = repo.changelog.tip()
+        self.revisions = {}
+
+    @property
+    def repo(self):
+        return self._repo()
+
+    def valid(self, repo):
+        return repo.changelog.tip() == self.tip
+
+    def __getitem__(self, rev):
+        r = self.revisions.get(rev)
+        if r is None:
+            r = self.revisions[rev] = Revision(self.repo.changelog, rev)
+        else:
+            hookmetrics.incr('cache_hits', cache='snapshot')
+        return r
+
+    def status(self, rev):
+        """Return (modified, added, removed) of 'rev' against its first
+        parent."""
+        r = self[rev]
+        if r.status is None:
+            p1 = r.parents[0] if r.parents else nullrev
+            st = self.repo.status(self.repo.changelog.node(p1), r.node)
+            r.status = (st[0], st[1], st[2])
+        return r.status
+
+    def changedfiles(self, rev):
+        """Return the sorted list of files changed by 'rev' against its
+        first parent."""
+        modified, added, removed = self.status(rev)
+        return sorted(modified + added + removed)
+
+
+def get(repo):
+    """Return the snapshot for the current state of 'repo'."""
+    repo = repo.unfiltered()
+    snap = getattr(repo, '_hooksnapshot', None)
+    if snap is None or not snap.valid(repo):
+        snap = repo._hooksnapshot = Snapshot(repo)
+        tr = repo.currenttransaction()
+        if tr is not None:
+            # postclose callbacks run in the order of their names, so this
+            # is queued after the 'changegroup-runhooks-...' callback that
+            # runs the changegroup and incoming hooks once unlocked
+            tr.addpostclose('hooksnapshot', lambda tr:
+                            repo._afterlock(lambda: drop(repo, snap)))
+    return snap
+
+
+def drop(repo, snap):
+    """Forget snapshot 'snap' of 'repo', unless it was replaced already."""
+    if getattr(repo, '_hooksnapshot', None) is snap:
+        del repo._hooksnapshot
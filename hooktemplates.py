@@ -0,0 +1,138 @@
+"""
+Compiled message templates shared by the notification hooks.
+
+Templates are compiled once per process and rendered from a small
+per-changeset Record holding the fields every sink needs (author, branch,
+short node, first line of the description, URL), which are computed only
+once per changeset however many sinks render it.
+
+Two template syntaxes are supported: 'percent' (Python %-formatting with
+named fields, as used by the [irker] template) and 'dollar' (string.Template
+syntax, as used by the Roundup comment and the mail header and subject).
+Each sink reads its templates from its own hgrc section, e.g.
+
+[irker]
+template = %(project)s: %(author)s %(branch)s * %(rev)s: %(logmsg)s %(url)s
+
+[hgroundup]
+template = ${changeset_id} (${branch}): ${commit_msg}
+
+[mail]
+subject-template = ${prefixes}${summary}
+"""
+
+from string import Template
+
+from mercurial.templatefilters import person
+from mercurial.encoding import fromlocal
+from mercurial.node import hex, short
+from mercurial import util
+
+import hooksnapshot
+
+# the Record fields, available to every template
+FIELDS = ('rev', 'node', 'short', 'user', 'author', 'branch', 'description',
+          'summary', 'date', 'url')
+
+_templates = {}
+_records = {}
+# records are kept for the changesets of one push, not the whole history
+MAXRECORDS = 10000
+
+
+class Record(object):
+    """The fields of a changeset shared by all templates."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, r, baseurl=None):
+        # 'r' is a hooksnapshot.Revision
+        self.rev = r.rev
+        self.node = hex(r.node)
+        self.short = short(r.node)
+        self.user = fromlocal(r.user)
+        self.author = fromlocal(person(r.user))
+        self.branch = r.branch
+        self.description = fromlocal(r.description)
+        lines = self.description.strip().splitlines()
+        self.summary = lines and lines[0] or ''
+        self.date = util.datestr(r.date)
+        if baseurl:
+            self.url = baseurl.rstrip('/') + '/rev/' + self.short
+        else:
+            self.url = ''
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+class Chain(object):
+    """Mapping looking up keys in several mappings in turn.
+
+    Used to render a Record together with sink-specific fields without
+    copying either.
+    """
+
+    def __init__(self, *maps):
+        self.maps = maps
+
+    def __getitem__(self, key):
+        for m in self.maps:
+            try:
+                return m[key]
+            except KeyError:
+                pass
+        raise KeyError(key)
+
+
+class PercentTemplate(object):
+
+    def __init__(self, text):
+        self.text = text
+
+    def render(self, *maps):
+        return self.text % Chain(*maps)
+
+
+class DollarTemplate(object):
+
+    def __init__(self, text):
+        self.template = Template(text)
+
+    def render(self, *maps):
+        return self.template.substitute(Chain(*maps))
+
+
+STYLES = {
+    'percent': PercentTemplate,
+    'dollar': DollarTemplate,
+}
+
+
+def compile(text, style='dollar'):
+    """Return the compiled template for 'text', compiling it only once."""
+    key = (style, text)
+    t = _templates.get(key)
+    if t is None:
+        t = _templates[key] = STYLES[style](text)
+    return t
+
+
+def get(ui, section, name, default, style='dollar'):
+    """Return the compiled template configured as section.name in hgrc."""
+    return compile(ui.config(section, name, default), style)
+
+
+def record(ui, repo, rev):
+    """Return the (cached) Record for revision 'rev' of 'repo'."""
+    r = hooksnapshot.get(repo)[rev]
+    baseurl = ui.config('web', 'baseurl')
+    key = (r.node, baseurl)
+    rec = _records.get(key)
+    if rec is None:
+        if len(_records) >= MAXRECORDS:
+            _records.clear()
+        rec = _records[key] = Record(r, baseurl)
+    return rec
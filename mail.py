@@ -1,7 +1,8 @@
 """
 Mercurial hook to send an email for each changeset to a specified address.
 
-For use as an "incoming" hook.
+For use as an "incoming" hook, or as a "changegroup" hook with
+python:/path/to/mail.py:changegroup.
 
 To set the SMTP server to something other than localhost, add a [smtp]
 section to your hgrc:
@@ -10,31 +11,83 @@ section to your hgrc:
 host = mail.python.org
 port = 25
 
+The connection timeout and the circuit breaker for the SMTP server are
+configured in the [hooksinks] section, see hooksinks.py.  If a hook daemon is
+configured (see hookdaemon.py), mail is sent through its connection pool.
+
+The changeset header at the top of the message and the subject can be
+changed with the `header-template` and `subject-template` properties in the
+[mail] section, using string.Template syntax; see HEADER_TEMPLATE and
+SUBJECT_TEMPLATE for the default values.
+
+Besides the `notify` address, which gets every changeset, changesets can be
+routed to other lists by the files they touch, with glob patterns relative
+to the repository root:
+
+[mail-routes]
+Doc/** = docs@python.org
+Lib/email/**, Lib/test/test_email/** = email-sig@python.org
+
+Routes with no address are ignored.  Mail is sent from the [mail] `sender`,
+else from the `notify` address, else from the list it goes to.
+
+Each changeset is rendered once however many lists it goes to.  In the
+changegroup hook, `digest = True` in the [mail] section sends each list a
+single message for the whole push instead of one per changeset; its subject
+is the `digest-subject-template` (see DIGEST_SUBJECT_TEMPLATE).
+
+Diffs are truncated, and the changesets left over only listed, once the
+hook's budget in the [hooks-budget] section is exceeded; see hookbudget.py.
+
 """
 
+# Mercurial hooks are not run with the hook's directory in sys.path
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from mercurial import cmdutil, patch
-from mercurial.node import nullid
-from mercurial.encoding import fromlocal
+from mercurial import match as matchmod
+from mercurial import patch
+from mercurial.node import nullid, short
 from mercurial.util import iterlines
 import smtplib
-import os
-import sys
 import traceback
 
+import hookbudget
+import hookmetrics
+import hooktemplates
+import hooksinks
+import hooksnapshot
+import hookdaemon
+
 BASE = 'https://hg.python.org/'
 CSET_URL = BASE + '%s/rev/%s'
 
+# same layout as the header of 'hg log'; ${extra} holds the optional
+# branch, bookmark, tag and parent lines
+HEADER_TEMPLATE = '''\
+changeset:   ${rev}:${short}
+${extra}user:        ${user}
+date:        ${date}'''
+SUBJECT_TEMPLATE = '${prefixes}${summary}'
+DIGEST_SUBJECT_TEMPLATE = '${prefixes}${count} new changesets'
 
-def send(smtp, sub, sender, to, body):
+
+def mimemessage(sub, body):
+    """Return the MIME message without its From and To headers, so that it
+    can be built once and addressed to several lists."""
     msg = MIMEMultipart()
     msg['Subject'] = Header(sub, 'utf8')
-    msg['To'] = to
-    msg['From'] = sender
     msg.attach(MIMEText(body, _subtype='plain', _charset='utf8'))
-    smtp.sendmail(sender, to, msg.as_string())
+    return msg
+
+def message(sub, sender, to, body):
+    return addressed(mimemessage(sub, body), sender, to)
+
+def send(smtp, sub, sender, to, body):
+    smtp.sendmail(sender, to, message(sub, sender, to, body))
 
 def strip_bin_diffs(chunks):
     stripped = []
@@ -64,7 +117,7 @@ def strip_blacklisted_files(chunks, blacklisted):
         stripped.append(chunk)
     return stripped
 
-def _incoming(ui, repo, **kwargs):
+def plain_output(ui):
     # Ensure that no fancying of output is enabled (e.g. coloring)
     os.environ['TERM'] = 'dumb'
     ui.setconfig('ui', 'interactive', 'False')
@@ -76,29 +129,63 @@ def _incoming(ui, repo, **kwargs):
     else:
         colormod._styles.clear()
 
+def header_extra(repo, ctx, parents):
+    """Return the optional lines of the changeset header, like 'hg log'."""
+    lines = []
+    if ctx.branch() != 'default':
+        lines.append('branch:      %s\n' % ctx.branch())
+    for bookmark in ctx.bookmarks():
+        lines.append('bookmark:    %s\n' % bookmark)
+    for tag in ctx.tags():
+        if tag != 'tip':
+            lines.append('tag:         %s\n' % tag)
+    # only show parents that are not simply the previous revision
+    if len(parents) < 2 and (not parents or parents[0] == ctx.rev() - 1):
+        parents = []
+    for p in parents:
+        lines.append('parent:      %d:%s\n' % (p, short(repo.changelog.node(p))))
+    return ''.join(lines)
+
+def repopath(repo):
+    """Return the path of 'repo' below BASE."""
+    return '/'.join(repo.root.split('/')[4:])
+
+def render(ui, repo, ctx, budget=None):
+    """Return the (subject, body) of the notification for 'ctx'.
+
+    The diff is truncated once 'budget', a hookbudget.Budget, is exceeded.
+    """
     blacklisted = ui.config('mail', 'diff-blacklist', '').split()
+    header = hooktemplates.get(ui, 'mail', 'header-template', HEADER_TEMPLATE)
+    subject = hooktemplates.get(ui, 'mail', 'subject-template',
+                                SUBJECT_TEMPLATE)
 
-    displayer = cmdutil.changeset_printer(ui, repo, False, False, True)
-    ctx = repo[kwargs['node']]
-    displayer.show(ctx)
-    log = displayer.hunk[ctx.rev()]
-    user = os.environ.get('HGPUSHER', 'local')
-    path = '/'.join(repo.root.split('/')[4:])
+    snap = hooksnapshot.get(repo)
+    r = snap[ctx.rev()]
+    rec = hooktemplates.record(ui, repo, ctx.rev())
+    path = repopath(repo)
 
     body = []
     #body += ['%s pushed %s to %s:' % (user, str(ctx), path), '']
     body += [CSET_URL % (path, ctx)]
-    body += [line for line in log.splitlines()[:-2]
-             if line != 'tag:         tip']
-    body += ['summary:\n  ' + fromlocal(ctx.description())]
+    extra = header_extra(repo, ctx, r.parents)
+    body += [header.render({'extra': extra}, rec)]
+    body += ['summary:\n  ' + rec.description]
     # ctx.files() gives us misleading info on merges, we use a diffstat instead
     body += ['', 'files:']
 
     diffopts = patch.diffopts(repo.ui, {'git': True, 'showfunc': True})
-    parents = ctx.parents()
-    node1 = parents and parents[0].node() or nullid
-    node2 = ctx.node()
-    diffchunks = list(patch.diff(repo, node1, node2, opts=diffopts))
+    parents = r.parents
+    node1 = parents and repo.changelog.node(parents[0]) or nullid
+    node2 = r.node
+    diffchunks = []
+    truncated = False
+    for chunk in patch.diff(repo, node1, node2, opts=diffopts):
+        if budget is not None and not budget.check('diff-bytes', len(chunk)):
+            truncated = True
+            break
+        diffchunks.append(chunk)
+    hookmetrics.incr('diff_bytes', sum(map(len, diffchunks)), hook='mail')
     diffstat = patch.diffstat(iterlines(diffchunks), width=60, git=True)
     for line in iterlines([''.join(diffstat)]):
         body.append(' ' + line)
@@ -106,23 +193,17 @@ def _incoming(ui, repo, **kwargs):
     diffchunks = strip_bin_diffs(diffchunks)
     diffchunks = strip_blacklisted_files(diffchunks, blacklisted)
     body.append(''.join(chunk for chunk in diffchunks))
+    if truncated:
+        budget.warn('diff of %s truncated' % ctx)
+        body.append('[diff truncated: %s]' % budget.exceeded)
 
     body.append('-- ')
     body.append('Repository URL: %s%s' % (BASE, path))
 
-    to = ui.config('mail', 'notify', None)
-    if to is None:
-        print 'no email address configured'
-        return False
-    from_ = ui.config('mail', 'sender', None)
-    if from_ is None:
-        from_ = to
-    sender = '%s <%s>' % (user, from_)
-
     prefixes = [path]
 
     if len(parents) == 2:
-        b1, b2, b = parents[0].branch(), parents[1].branch(), ctx.branch()
+        b1, b2, b = snap[parents[0]].branch, snap[parents[1]].branch, r.branch
         if b in (b1, b2):
             bp = b2 if b == b1 else b1
             # normal case
@@ -131,11 +212,11 @@ def _incoming(ui, repo, **kwargs):
             # XXX really??
             prefixes.append('(merge %s + %s -> %s)' % (b1, b2, b))
     else:
-        branch = ctx.branch()
+        branch = r.branch
         if branch != 'default':
             prefixes.append('(%s)' % branch)
 
-    desc = ctx.description().splitlines()[0]
+    desc = rec.summary
     if len(desc) > 80:
         desc = desc[:80]
         if ' ' in desc:
@@ -146,18 +227,158 @@ def _incoming(ui, repo, **kwargs):
     else:
         prefixes = ''
 
-    subj = prefixes + desc
+    subj = subject.render({'prefixes': prefixes, 'summary': desc}, rec)
+    return subj, '\n'.join(body) + '\n'
+
+def summary_lines(ui, repo, revs):
+    """Return one line with the URL and summary of each of 'revs'."""
+    path = repopath(repo)
+    lines = []
+    for rev in revs:
+        rec = hooktemplates.record(ui, repo, rev)
+        lines.append('  %s  %s' % (CSET_URL % (path, rec.short), rec.summary))
+    return lines
+
+def render_summary(ui, repo, revs, reason):
+    """Return the (subject, body) of the summary-only notification for
+    'revs', sent instead of their full messages over budget."""
+    path = repopath(repo)
+    subj = '%s: %d more changesets (summary only)' % (path, len(revs))
+    body = ['%d more changesets in %s%s are only listed, the hook budget '
+            'was exceeded (%s):' % (len(revs), BASE, path, reason), '']
+    body += summary_lines(ui, repo, revs)
+    return subj, '\n'.join(body) + '\n'
+
+def render_digest(ui, repo, revs, renderings):
+    """Return the (subject, body) of a single notification for all of
+    'revs', made of their (subject, body) in 'renderings'."""
+    subject = hooktemplates.get(ui, 'mail', 'digest-subject-template',
+                                DIGEST_SUBJECT_TEMPLATE)
+    snap = hooksnapshot.get(repo)
+    path = repopath(repo)
+
+    branches = []
+    for rev in revs:
+        if snap[rev].branch not in branches:
+            branches.append(snap[rev].branch)
+    prefixes = [path]
+    if branches != ['default']:
+        prefixes.append('(%s)' % ', '.join(branches))
+
+    body = ['%d new changesets in %s%s:' % (len(revs), BASE, path), '']
+    body += summary_lines(ui, repo, revs)
+    body.append('')
+    for rev in revs:
+        subj, text = renderings[rev]
+        body += ['=' * 70, subj, '', text]
+
+    subj = subject.render({'prefixes': ' '.join(prefixes) + ': ',
+                           'count': len(revs)})
+    return subj, '\n'.join(body)
+
+def getroutes(ui, repo):
+    """Return the [mail-routes] table as a list of (matcher, addresses)."""
+    routes = []
+    for patterns, addresses in ui.configitems('mail-routes'):
+        patterns = [p.strip() for p in patterns.split(',') if p.strip()]
+        addresses = [a.strip() for a in addresses.split(',') if a.strip()]
+        if not patterns or not addresses:
+            ui.debug('mail: ignoring empty route %r\n' % patterns)
+            continue
+        m = matchmod.match(repo.root, '', patterns, default='glob')
+        routes.append((m, addresses))
+    return routes
 
+def recipients(repo, rev, notify, routes):
+    """Return the lists to notify of changeset 'rev': the [mail] notify
+    address, if any, and the lists whose route matches one of its files."""
+    lists = []
+    if notify:
+        lists.append(notify)
+    if routes:
+        files = hooksnapshot.get(repo).changedfiles(rev)
+        for m, addresses in routes:
+            for f in files:
+                if m(f):
+                    lists.extend(a for a in addresses if a not in lists)
+                    break
+    return lists
+
+def addressed(msg, sender, to):
+    """Return MIME message 'msg' as a string, sent from 'sender' to 'to'."""
+    for header in ('From', 'To'):
+        del msg[header]
+    msg['To'] = to
+    msg['From'] = sender
+    return msg.as_string()
+
+def deliver(ui, repo, messages):
+    """Send the (sender, to, message string) triples over a single SMTP
+    connection.
+
+    Return False if the SMTP server is skipped by its circuit breaker."""
     host = ui.config('smtp', 'host', '')
     port = int(ui.config('smtp', 'port', 0))
-    smtp = smtplib.SMTP(host, port)
-    username = ui.config('smtp', 'username', '')
-    if username:
-        smtp.login(username, ui.config('smtp', 'password', ''))
-    send(smtp, subj, sender, to, '\n'.join(body) + '\n')
-    smtp.close()
-
-    ui.status('notified %s of incoming changeset %s\n' % (to, ctx))
+    breaker = hooksinks.Sink(ui, repo, 'smtp', '%s:%d' % (host, port))
+    if not breaker.available():
+        return False
+
+    def sendmail():
+        with hookmetrics.sink('smtp', hook='mail'):
+            username = ui.config('smtp', 'username', '')
+            password = ui.config('smtp', 'password', '')
+            pending = list(messages)
+            while pending:
+                sender, to, msg = pending[0]
+                if not hookdaemon.sendmail(ui, host, port, username,
+                                           password, sender, to, msg,
+                                           breaker.timeout):
+                    break
+                pending.pop(0)
+            if not pending:
+                return
+            smtp = smtplib.SMTP(host, port, timeout=breaker.timeout)
+            if username:
+                smtp.login(username, password)
+            for sender, to, msg in pending:
+                smtp.sendmail(sender, to, msg)
+            smtp.close()
+    breaker.call(sendmail)
+    return True
+
+def getsender(ui, notify, to):
+    """Return the sender of the mail to list 'to': the [mail] sender, else
+    the notify address, else the list itself."""
+    from_ = ui.config('mail', 'sender', None)
+    if from_ is None:
+        from_ = notify or to
+    user = os.environ.get('HGPUSHER', 'local')
+    return '%s <%s>' % (user, from_)
+
+def _incoming(ui, repo, **kwargs):
+    plain_output(ui)
+
+    to = ui.config('mail', 'notify', None)
+    routes = getroutes(ui, repo)
+    if to is None and not routes:
+        print 'no email address configured'
+        return False
+
+    ctx = repo[kwargs['node']]
+    lists = recipients(repo, ctx.rev(), to, routes)
+    if not lists:
+        return False
+    hookmetrics.incr('changesets', hook='mail')
+    budget = hookbudget.Budget(ui, 'mail')
+    msg = mimemessage(*render(ui, repo, ctx, budget))
+
+    messages = []
+    for l in lists:
+        sender = getsender(ui, to, l)
+        messages.append((sender, l, addressed(msg, sender, l)))
+    if deliver(ui, repo, messages):
+        ui.status('notified %s of incoming changeset %s\n'
+                  % (', '.join(lists), ctx))
     return False
 
 def incoming(ui, repo, **kwargs):
@@ -167,4 +388,94 @@ def incoming(ui, repo, **kwargs):
     except:
         traceback.print_exc()
         raise
+    finally:
+        hookmetrics.flush(ui)
+
+def _changegroup(ui, repo, node, **kwargs):
+    plain_output(ui)
+
+    to = ui.config('mail', 'notify', None)
+    routes = getroutes(ui, repo)
+    if to is None and not routes:
+        print 'no email address configured'
+        return False
+    digest = ui.configbool('mail', 'digest', False)
+
+    start = repo[node].rev()
+    hookmetrics.incr('changesets', len(repo) - start, hook='mail')
+    # the revisions each list is notified of
+    lists = []
+    bylist = {}
+    notified = []
+    for rev in xrange(start, len(repo)):
+        rcpts = recipients(repo, rev, to, routes)
+        if rcpts:
+            notified.append((rev, rcpts))
+        for l in rcpts:
+            if l not in bylist:
+                lists.append(l)
+                bylist[l] = []
+            bylist[l].append(rev)
+    digests = [l for l in lists if digest and len(bylist[l]) > 1]
 
+    # render each changeset once for all its lists while the budget lasts;
+    # the others are only listed in a summary
+    budget = hookbudget.Budget(ui, 'mail')
+    messages = []
+    # the renderings for the digests, built once all are known
+    renderings = {}
+    over = dict((l, []) for l in lists)
+    exceeded = False
+    for rev, rcpts in notified:
+        if not exceeded and not budget.check('changesets'):
+            budget.warn('only sending a summary of the changesets from %d'
+                        % rev)
+            exceeded = True
+        if exceeded:
+            for l in rcpts:
+                over[l].append(rev)
+            continue
+        subj, body = render(ui, repo, repo[rev], budget)
+        msg = None
+        for l in rcpts:
+            if l in digests:
+                renderings[rev] = subj, body
+                continue
+            if msg is None:
+                msg = mimemessage(subj, body)
+            sender = getsender(ui, to, l)
+            messages.append((sender, l, addressed(msg, sender, l)))
+
+    # lists getting the same changesets share their digest
+    bodies = {}
+    for l in digests:
+        revs = tuple([rev for rev in bylist[l] if rev in renderings])
+        if not revs:
+            continue
+        if revs not in bodies:
+            bodies[revs] = mimemessage(*render_digest(ui, repo, revs,
+                                                      renderings))
+        sender = getsender(ui, to, l)
+        messages.append((sender, l, addressed(bodies[revs], sender, l)))
+    # only the message strings are needed from here on
+    del renderings, bodies
+    for l in lists:
+        if over[l]:
+            subj, body = render_summary(ui, repo, over[l], budget.exceeded)
+            sender = getsender(ui, to, l)
+            messages.append((sender, l, message(subj, sender, l, body)))
+    if messages and deliver(ui, repo, messages):
+        for l in lists:
+            ui.status('notified %s of %d incoming changesets\n'
+                      % (l, len(bylist[l])))
+    return False
+
+def changegroup(ui, repo, **kwargs):
+    # Make error reporting easier
+    try:
+        return _changegroup(ui, repo, **kwargs)
+    except:
+        traceback.print_exc()
+        raise
+    finally:
+        hookmetrics.flush(ui)